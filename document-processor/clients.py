@@ -8,6 +8,7 @@ import os
 import time
 import json
 import uuid
+import threading
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
@@ -22,9 +23,27 @@ from db_schema import initialize_database_schema
 
 load_dotenv()
 
+# Логи LLM-запросов копятся в памяти и пишутся одной вставкой, когда набирается пачка
+LLM_LOG_BATCH_SIZE = int(os.getenv("LLM_LOG_BATCH_SIZE", "50"))
+# Предел буфера, если запись логов не удается (БД недоступна)
+LLM_LOG_BUFFER_LIMIT = LLM_LOG_BATCH_SIZE * 20
+
+_LLM_LOG_COLUMNS = (
+    "request_timestamp_start, request_timestamp_end, duration_seconds, is_success, request_type, model_name, "
+    "prompt, raw_response, error_message, prompt_tokens, completion_tokens, tenant_id, doc_id, chunk_id"
+)
+_LLM_LOG_TEMPLATE = (
+    "(%(start_time)s, %(end_time)s, %(duration)s, %(is_success)s, %(request_type)s, %(model_name)s, "
+    "%(prompt)s, %(raw_response)s, %(error_message)s, %(prompt_tokens)s, %(completion_tokens)s, "
+    "%(tenant_id)s, %(doc_id)s, %(chunk_id)s)"
+)
+
 class DatabaseClient:
     """Клиент для работы с PostgreSQL."""
     def __init__(self):
+        # При переподключении (_reconnect вызывает __init__) накопленные логи сохраняются
+        self._llm_log_buffer: List[Dict] = getattr(self, "_llm_log_buffer", [])
+        self._llm_log_lock = getattr(self, "_llm_log_lock", threading.Lock())
         try:
             self.conn = psycopg2.connect(
                 host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT"),
@@ -40,6 +59,7 @@ class DatabaseClient:
 
     def close(self):
         if self.conn and not self.conn.closed:
+            self.flush_llm_logs()
             self.conn.close()
             logging.info("DB: Соединение с PostgreSQL успешно закрыто.")
 
@@ -208,14 +228,45 @@ class DatabaseClient:
                 raise
 
     def log_llm_request(self, log_data: Dict):
-        query = "INSERT INTO llm_requests_log (request_timestamp_start, request_timestamp_end, duration_seconds, is_success, request_type, model_name, prompt, raw_response, error_message, prompt_tokens, completion_tokens, tenant_id, doc_id, chunk_id) VALUES (%(start_time)s, %(end_time)s, %(duration)s, %(is_success)s, %(request_type)s, %(model_name)s, %(prompt)s, %(raw_response)s, %(error_message)s, %(prompt_tokens)s, %(completion_tokens)s, %(tenant_id)s, %(doc_id)s, %(chunk_id)s);"
+        """Ставит лог LLM-запроса в очередь; запись идет пачками (см. flush_llm_logs)."""
+        with self._llm_log_lock:
+            self._llm_log_buffer.append(log_data)
+            if len(self._llm_log_buffer) < LLM_LOG_BATCH_SIZE:
+                return
+        self.flush_llm_logs()
+
+    def flush_llm_logs(self):
+        """Записывает накопленные логи LLM-запросов одной вставкой execute_values."""
+        with self._llm_log_lock:
+            rows, self._llm_log_buffer = self._llm_log_buffer, []
+        if not rows:
+            return
         try:
             with self.conn.cursor() as cur:
-                cur.execute(query, log_data)
+                psycopg2.extras.execute_values(
+                    cur,
+                    f"INSERT INTO llm_requests_log ({_LLM_LOG_COLUMNS}) VALUES %s;",
+                    rows,
+                    template=_LLM_LOG_TEMPLATE,
+                    page_size=100,
+                )
                 self.conn.commit()
         except Exception as e:
-            logging.error(f"DB: Не удалось записать лог LLM-запроса в базу данных! Ошибка: {e}", exc_info=True)
-            self.conn.rollback()
+            logging.error(f"DB: Не удалось записать {len(rows)} лог(ов) LLM-запросов в базу данных! Ошибка: {e}", exc_info=True)
+            # Вызывается и из close() при переподключении: разорванное соединение не должно прерывать его
+            if not self.conn.closed:
+                try:
+                    self.conn.rollback()
+                except psycopg2.Error:
+                    pass
+            # Строки возвращаются в буфер, их запишет следующий flush (в том числе после переподключения);
+            # при долгой недоступности БД храним не больше LLM_LOG_BUFFER_LIMIT самых свежих записей
+            with self._llm_log_lock:
+                self._llm_log_buffer[:0] = rows
+                overflow = len(self._llm_log_buffer) - LLM_LOG_BUFFER_LIMIT
+                if overflow > 0:
+                    del self._llm_log_buffer[:overflow]
+                    logging.warning(f"DB: Буфер логов LLM переполнен, отброшено {overflow} старых записей.")
 
 class MinioClient:
     def __init__(self):
@@ -74,6 +74,8 @@ def initialize_database_schema(conn):
         cur.execute("COMMENT ON COLUMN documents.metadata IS 'Прочие метаданные, извлеченные парсерами (размер, даты и т.д.).';")
 
         cur.execute("CREATE INDEX IF NOT EXISTS ix_documents_tenant_id ON documents (tenant_id);")
+        # Фильтр по дате загрузки применяется в поисковых запросах knowledge-search-api через JOIN documents
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_documents_uploaded_at ON documents (uploaded_at);")
         logging.info(" -> Индексы для 'documents' готовы.")
 
         # --- Таблица chunks ---
@@ -134,7 +136,10 @@ def initialize_database_schema(conn):
         cur.execute("CREATE INDEX IF NOT EXISTS ix_chunks_tenant_id ON chunks (tenant_id);")
         cur.execute("CREATE INDEX IF NOT EXISTS ix_chunks_section ON chunks (section);")
         cur.execute("CREATE INDEX IF NOT EXISTS ix_chunks_block_type ON chunks (block_type);")
+        # Сборка таблицы из фрагментов в поисковых запросах knowledge-search-api
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_chunks_doc_section ON chunks (doc_id, section, chunk_id);")
         cur.execute("CREATE INDEX IF NOT EXISTS chunks_text_tsv_idx ON chunks USING GIN(text_tsv);")
+        ensure_embedding_hnsw_index(cur, get_vector_dimension(conn))
         logging.info(" -> Индексы для 'chunks' готовы.")
 
         cur.execute("""CREATE OR REPLACE FUNCTION update_chunks_tsv() RETURNS TRIGGER AS $$ BEGIN NEW.text_tsv := to_tsvector('russian', NEW.text) || to_tsvector('english', NEW.text); RETURN NEW; END; $$ LANGUAGE plpgsql;""")
@@ -185,6 +190,23 @@ def initialize_database_schema(conn):
         conn.commit()
         logging.info("DB_SCHEMA: Схема базы данных успешно настроена и задокументирована.")
 
+# HNSW по типу vector ограничен 2000 измерениями, по halfvec — 4000
+HNSW_MAX_HALFVEC_DIM = 4000
+
+def ensure_embedding_hnsw_index(cur, dimension: int) -> None:
+    """
+    Приближенный поиск ближайших соседей для dense-поиска: HNSW-индекс по приведению
+    chunks.embedding к halfvec текущей размерности (pgvector >= 0.7). Индекс удаляется вместе
+    с колонкой при миграции эмбеддингов, поэтому после замены колонки вызывается повторно.
+    """
+    if not 0 < dimension <= HNSW_MAX_HALFVEC_DIM:
+        logging.warning(f"HNSW-индекс не создан: размерность {dimension} не поддерживается (максимум {HNSW_MAX_HALFVEC_DIM}).")
+        return
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS ix_chunks_embedding_hnsw ON chunks
+        USING hnsw ((embedding::halfvec({dimension})) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+    """)
+
 def get_vector_dimension(conn) -> int:
     """Получает текущую размерность колонки embedding из БД."""
     try:
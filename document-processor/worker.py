@@ -26,6 +26,7 @@ from psycopg2.extras import DictCursor, execute_values
 
 # Локальные модули
 from clients import DatabaseClient, MinioClient, Neo4jClient
+from db_schema import ensure_embedding_hnsw_index
 from parser_any import parse_any
 from chunker import SmartChunker
 from enrichment import extract_metadata_with_llm, extract_relations_with_llm
@@ -359,6 +360,8 @@ def enrichment_worker_loop(stop_event: threading.Event, db: DatabaseClient, neo4
                             executor.map(lambda chunk: process_enrichment_stage([chunk], stage), chunks_to_process)
                     else: # Для 'embedding_generation'
                         process_enrichment_stage(chunks_to_process, stage)
+                    # Логи LLM-запросов этапа пишутся одной вставкой
+                    db.flush_llm_logs()
                         
                     processed_in_cycle += len(chunks_to_process)
             
@@ -405,6 +408,22 @@ def deletion_worker_loop(stop_event: threading.Event, db: DatabaseClient, minio:
             METRICS["processing_errors_total"].labels(worker_type='deletion', stage='main').inc()
             time.sleep(5)
 
+def _fetch_embedding_dependent_views(cur) -> List[tuple]:
+    """Материализованные представления, зависящие от chunks.embedding: (имя, определение, DDL индексов)."""
+    cur.execute("""
+        SELECT DISTINCT v.oid, v.oid::regclass::text, pg_get_viewdef(v.oid)
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class AND v.relkind = 'm'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = 'chunks'::regclass AND a.attname = 'embedding';
+    """)
+    views = []
+    for view_oid, view_name, view_definition in cur.fetchall():
+        cur.execute("SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s;", (view_oid,))
+        views.append((view_name, view_definition.rstrip().rstrip(";"), [row[0] for row in cur.fetchall()]))
+    return views
+
 def migration_worker_loop(stop_event: threading.Event, db: DatabaseClient, embed_model: Any):
     """Специализированный воркер, выполняющий миграцию эмбеддингов."""
     logger = logging.getLogger(threading.current_thread().name)
@@ -495,10 +514,25 @@ def migration_worker_loop(stop_event: threading.Event, db: DatabaseClient, embed
     logger.info("Атомарная замена колонок...")
     with conn.cursor() as cur:
         cur.execute("BEGIN;")
+        # Представления над chunks.embedding (например, tenant_chunk_stats из knowledge_base_api)
+        # не дают удалить колонку — пересоздаем их по определению из каталога в той же транзакции
+        dependent_views = _fetch_embedding_dependent_views(cur)
+        for view_name, _, _ in dependent_views:
+            cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name};")
         cur.execute("ALTER TABLE chunks DROP COLUMN embedding;")
         cur.execute("ALTER TABLE chunks RENAME COLUMN embedding_new TO embedding;")
+        for view_name, view_definition, index_definitions in dependent_views:
+            cur.execute(f"CREATE MATERIALIZED VIEW {view_name} AS {view_definition}")
+            for index_definition in index_definitions:
+                cur.execute(index_definition)
         cur.execute("COMMIT;")
 
+    # HNSW-индекс удален вместе со старой колонкой — строим его заново для новой размерности
+    logger.info("Построение HNSW-индекса для новой колонки embedding...")
+    with conn.cursor() as cur:
+        ensure_embedding_hnsw_index(cur, target_dimension)
+    conn.commit()
+
     new_config = {"model_name": target_model_name, "dimension": target_dimension, "version": target_version}
     with conn.cursor() as cur:
         cur.execute(
@@ -1,11 +1,23 @@
 # clients.py
 import os
+import re
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 import psycopg2.pool
-from neo4j import GraphDatabase
-from sentence_transformers import SentenceTransformer
-from typing import Optional
+import numpy as np
+import orjson
+import requests
+import torch
+from pgvector.psycopg2 import register_vector
+from neo4j import AsyncDriver, AsyncGraphDatabase, GraphDatabase
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from typing import List, Optional, Sequence, Tuple, Union
 from contextlib import contextmanager  # <-- ИСПРАВЛЕНИЕ: Добавлен этот импорт
 
 class PostgreSQLClient:
@@ -14,6 +26,11 @@ class PostgreSQLClient:
     def __init__(self, db_params: dict):
         self.db_params = db_params
         self.pool: psycopg2.pool.ThreadedConnectionPool | None = None
+        # Имена подготовленных (PREPARE) запросов для каждого соединения пула
+        self._prepared: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._prepared_lock = threading.Lock()
+        # Размерность chunks.embedding (задает и меняет при миграции модели document-processor)
+        self.embedding_dim: Optional[int] = None
         self._init_pool()
 
     def _init_pool(self):
@@ -24,7 +41,17 @@ class PostgreSQLClient:
                 maxconn=max_connections,
                 **self.db_params,
             )
-            print("DB: Успешное подключение к PostgreSQL через пул.")
+            # Адаптер pgvector регистрируется глобально: numpy-массивы передаются как vector
+            # без поэлементного преобразования Python-списка в строку
+            conn = self.pool.getconn()
+            try:
+                register_vector(conn, globally=True)
+                # JSONB (chunks.metadata и др.) разбирается orjson вместо стандартного json
+                psycopg2.extras.register_default_jsonb(conn_or_curs=conn, globally=True, loads=orjson.loads)
+                self.embedding_dim = _fetch_embedding_dim(conn)
+            finally:
+                self.pool.putconn(conn)
+            print("DB: Успешное подключение к PostgreSQL через пул и регистрация pgvector.")
         except psycopg2.OperationalError as e:
             print(f"DB: КРИТИЧЕСКАЯ ОШИБКА подключения к PostgreSQL: {e}")
             raise
@@ -55,30 +82,451 @@ class PostgreSQLClient:
         finally:
             cursor.close()
             self.pool.putconn(conn)
-            
+
+    def execute_prepared(self, cursor, sql: str, params: Sequence) -> None:
+        """
+        Выполняет запрос как серверный подготовленный оператор: при первом вызове на соединении
+        делает PREPARE (разбор и планирование), затем только EXECUTE с параметрами.
+        Запрос пишется в обычном стиле psycopg2 (%s, %% для литерального %).
+        При DB_PREPARED_STATEMENTS=false (например, за PgBouncer в режиме transaction)
+        выполняется как обычный запрос.
+        """
+        if not PREPARED_STATEMENTS_ENABLED:
+            cursor.execute(sql, params)
+            return
+
+        conn = cursor.connection
+        name = "ks_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+        with self._prepared_lock:
+            prepared = self._prepared.setdefault(conn, set())
+            is_prepared = name in prepared
+        if not is_prepared:
+            cursor.execute(f"PREPARE {name} AS {_to_positional_params(sql)}")
+            with self._prepared_lock:
+                prepared.add(name)
+        try:
+            if params:
+                cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            else:
+                cursor.execute(f"EXECUTE {name}")
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Сессия на сервере была сброшена — подготовим запрос заново при следующем вызове
+            with self._prepared_lock:
+                prepared.discard(name)
+            raise
+
+
+def _fetch_embedding_dim(conn) -> Optional[int]:
+    """Размерность колонки chunks.embedding из каталога БД; None, если колонки нет или размерность не задана."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT atttypmod FROM pg_attribute
+            WHERE attrelid = to_regclass('chunks') AND attname = 'embedding' AND NOT attisdropped
+        """)
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row and row[0] > 0 else None
+
+
+PREPARED_STATEMENTS_ENABLED = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() == 'true'
+_PARAM_PLACEHOLDER_RE = re.compile(r'%%|%s')
+
+def _to_positional_params(sql: str) -> str:
+    """Переводит плейсхолдеры psycopg2 (%s) в позиционные $1..$n для PREPARE."""
+    counter = iter(range(1, sql.count("%s") + 1))
+    body = _PARAM_PLACEHOLDER_RE.sub(lambda m: "%" if m.group() == "%%" else f"${next(counter)}", sql)
+    return body.strip().rstrip(";")
+
 class Neo4jClient:
-    """Клиент для работы с графовой базой данных Neo4j."""
+    """
+    Клиент для работы с графовой базой данных Neo4j.
+    Синхронный драйвер используется для проверок состояния, асинхронный (с общим
+    пулом Bolt-соединений) — для графового поиска в пути запроса.
+    """
     def __init__(self, uri, user, password):
         self.driver: Optional[GraphDatabase.driver] = None
+        self.async_driver: Optional[AsyncDriver] = None
+        # Явно заданная база избавляет сессии от запроса маршрутизации за базой по умолчанию
+        self.database = os.getenv("NEO4J_DATABASE", "neo4j")
         try:
             self.driver = GraphDatabase.driver(uri, auth=(user, password))
             self.driver.verify_connectivity()
+            self.async_driver = AsyncGraphDatabase.driver(
+                uri,
+                auth=(user, password),
+                max_connection_pool_size=int(os.getenv("NEO4J_MAX_POOL_SIZE", "32")),
+                connection_acquisition_timeout=float(os.getenv("NEO4J_ACQUISITION_TIMEOUT", "5")),
+            )
             print("Neo4j: Успешное подключение.")
         except Exception as e:
             print(f"Neo4j: ОШИБКА подключения: {e}. Функционал графа будет отключен.")
+            if self.driver is not None:
+                self.driver.close()
             self.driver = None
+            self.async_driver = None
 
-    def close(self):
+    async def close(self):
+        if self.async_driver is not None:
+            await self.async_driver.close()
         if self.driver is not None:
             self.driver.close()
             print("Neo4j: Соединение успешно закрыто.")
 
+class RemoteEmbedder:
+    """
+    Embedding-модель, размещенная на внешнем сервере инференса (Infinity, OpenAI-совместимый
+    /embeddings). Повторяет используемую часть интерфейса SentenceTransformer.encode, поэтому
+    веса не загружаются в каждый воркер, а сервер сам батчит запросы от всех воркеров.
+    """
+
+    def __init__(self, base_url: str, model_name: str, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.model_name = model_name
+        self.timeout = timeout
+        # Session переиспользует TCP-соединения с сервером инференса между запросами
+        self.session = requests.Session()
+
+    def encode(
+        self,
+        sentences: Union[str, Sequence[str]],
+        batch_size: int = 32,
+        show_progress_bar: Optional[bool] = None,
+        convert_to_tensor: bool = False,
+        normalize_embeddings: bool = False,
+        **_kwargs,
+    ):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), batch_size):
+            response = self.session.post(
+                f"{self.base_url}/embeddings",
+                json={"model": self.model_name, "input": texts[start:start + batch_size]},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            vectors.extend(item["embedding"] for item in data)
+
+        embeddings = np.asarray(vectors, dtype=np.float32)
+        if normalize_embeddings and len(embeddings):
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        if single:
+            embeddings = embeddings[0]
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+    def close(self):
+        self.session.close()
+
+
+class RemoteReranker:
+    """
+    Реранкер на внешнем сервере инференса (Infinity /rerank). Повторяет используемую часть
+    интерфейса CrossEncoder.predict: пары (query, text) группируются по запросу.
+    """
+
+    def __init__(self, base_url: str, model_name: str, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.model_name = model_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def predict(self, sentences: Sequence[Sequence[str]], **_kwargs) -> np.ndarray:
+        scores = np.zeros(len(sentences), dtype=np.float32)
+        positions_by_query: dict = {}
+        for i, (query, text) in enumerate(sentences):
+            positions_by_query.setdefault(query, []).append((i, text))
+
+        for query, items in positions_by_query.items():
+            response = self.session.post(
+                f"{self.base_url}/rerank",
+                json={
+                    "model": self.model_name, "query": query,
+                    "documents": [text for _, text in items], "return_documents": False,
+                },
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            for result in response.json()["results"]:
+                scores[items[result["index"]][0]] = result["relevance_score"]
+        return scores
+
+    def close(self):
+        self.session.close()
+
+
+def _create_onnx_session(model_path: str, device: str):
+    """Создает сессию ONNX Runtime с полной оптимизацией графа (fusion LayerNorm/GELU/attention)."""
+    import onnxruntime as ort  # опциональная зависимость, нужна только при заданном *_ONNX_PATH
+
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = os.cpu_count() or 1
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = ["CPUExecutionProvider"]
+    if device == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+        providers.insert(0, "CUDAExecutionProvider")
+    return ort.InferenceSession(model_path, sess_options=so, providers=providers)
+
+
+def _quantized_onnx_path(model_path: str) -> str:
+    """
+    Возвращает путь к INT8-версии ONNX-модели, при первом запуске создавая ее
+    динамической квантизацией весов MatMul/Gemm (результат кэшируется рядом с исходной моделью).
+    Файл пишется во временный и атомарно переименовывается, поэтому одновременно стартующие
+    воркеры не увидят недописанную модель. Если записать не удалось (например, том только
+    для чтения), используется исходная fp32-модель.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    root, ext = os.path.splitext(model_path)
+    int8_path = f"{root}.int8{ext}"
+    if os.path.exists(int8_path):
+        return int8_path
+
+    print(f"ONNX: квантизация {model_path} -> {int8_path} (INT8)...")
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(int8_path) or ".", suffix=ext)
+        os.close(fd)
+        quantize_dynamic(
+            model_path, tmp_path,
+            weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"],
+        )
+        os.replace(tmp_path, int8_path)
+        return int8_path
+    except Exception as e:
+        print(f"ONNX: не удалось создать INT8-модель ({e}), используется {model_path}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return model_path
+
+
+class _OnnxModel:
+    """Общая часть ONNX-обертки: токенизатор исходной модели и сессия ORT."""
+
+    def __init__(self, model_path: str, model_name: str, device: str, max_length: int):
+        from transformers import AutoTokenizer
+
+        self.session = _create_onnx_session(model_path, device)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.max_length = max_length
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _run(self, *texts) -> Tuple[np.ndarray, np.ndarray]:
+        # Паддинг до самой длинной последовательности батча, а не до max_length
+        encoded = self.tokenizer(
+            *texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+        )
+        return self._run_encoded(encoded)
+
+    def _run_encoded(self, encoded) -> Tuple[np.ndarray, np.ndarray]:
+        feeds = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        return self.session.run(None, feeds)[0], encoded["attention_mask"]
+
+
+class OnnxEmbedder(_OnnxModel):
+    """
+    Embedding-модель, экспортированная в ONNX (optimum-cli export onnx --task feature-extraction).
+    Повторяет используемую часть интерфейса SentenceTransformer.encode.
+    """
+
+    def __init__(self, model_path: str, model_name: str, device: str = "cpu",
+                 pooling: str = "cls", max_length: int = 512):
+        super().__init__(model_path, model_name, device, max_length)
+        self.pooling = pooling
+
+    def encode(
+        self,
+        sentences: Union[str, Sequence[str]],
+        batch_size: int = 32,
+        show_progress_bar: Optional[bool] = None,
+        convert_to_tensor: bool = False,
+        normalize_embeddings: bool = False,
+        **_kwargs,
+    ):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            hidden, mask = self._run(texts[start:start + batch_size])
+            if self.pooling == "mean":
+                mask = mask[..., None].astype(np.float32)
+                batches.append((hidden * mask).sum(axis=1) / mask.sum(axis=1).clip(min=1e-9))
+            else:
+                batches.append(hidden[:, 0])
+
+        embeddings = np.concatenate(batches).astype(np.float32) if batches else np.empty((0, 0), np.float32)
+        if normalize_embeddings and len(embeddings):
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        if single:
+            embeddings = embeddings[0]
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+
+class OnnxCrossEncoder(_OnnxModel):
+    """
+    Реранкер (CrossEncoder), экспортированный в ONNX. Повторяет интерфейс CrossEncoder.predict
+    и, как CrossEncoder с одним выходом, возвращает sigmoid от логитов.
+    """
+
+    def __init__(self, model_path: str, model_name: str, device: str = "cpu", max_length: int = 512,
+                 token_cache_size: int = 50_000):
+        super().__init__(model_path, model_name, device, max_length)
+        # Токены текстов чанков: один и тот же чанк попадает в кандидаты многих запросов,
+        # поэтому он токенизируется один раз за время жизни процесса
+        self._token_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._token_cache_size = token_cache_size
+        self._token_cache_lock = threading.Lock()
+
+    def _tokenize_cached(self, texts: List[str]) -> List[List[int]]:
+        with self._token_cache_lock:
+            cached = [self._token_cache.get(text) for text in texts]
+            # LRU: попадание переносит текст в конец, вытесняются давно не встречавшиеся чанки
+            for text, ids in zip(texts, cached):
+                if ids is not None:
+                    self._token_cache.move_to_end(text)
+        missing = list(dict.fromkeys(text for text, ids in zip(texts, cached) if ids is None))
+        if missing:
+            fresh = self.tokenizer(
+                missing, add_special_tokens=False, truncation=True, max_length=self.max_length
+            )["input_ids"]
+            fresh_by_text = dict(zip(missing, fresh))
+            with self._token_cache_lock:
+                for text, ids in fresh_by_text.items():
+                    self._token_cache[text] = ids
+                while len(self._token_cache) > self._token_cache_size:
+                    self._token_cache.popitem(last=False)
+            cached = [ids if ids is not None else fresh_by_text[text] for text, ids in zip(texts, cached)]
+        return cached
+
+    def predict(self, sentences: Sequence[Sequence[str]], batch_size: int = 32, **_kwargs) -> np.ndarray:
+        # Токенизируются только уникальные запросы (обычно один) и не встречавшиеся ранее чанки;
+        # пары [CLS] q [SEP] chunk [SEP] собираются из готовых id
+        if not sentences:
+            return np.empty(0, dtype=np.float32)
+        queries = list(dict.fromkeys(q for q, _ in sentences))
+        query_ids = dict(zip(queries, self.tokenizer(
+            queries, add_special_tokens=False, truncation=True, max_length=self.max_length
+        )["input_ids"]))
+        chunk_ids = self._tokenize_cached([t for _, t in sentences])
+
+        scores = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            features = [
+                self.tokenizer.prepare_for_model(
+                    query_ids[q], ids, truncation="longest_first", max_length=self.max_length,
+                )
+                for (q, _), ids in zip(batch, chunk_ids[start:start + batch_size])
+            ]
+            encoded = self.tokenizer.pad(features, padding=True, return_tensors="np")
+            logits, _ = self._run_encoded(encoded)
+            scores.append(logits.reshape(len(batch), -1)[:, 0])
+        return (1.0 / (1.0 + np.exp(-np.concatenate(scores)))).astype(np.float32)
+
+
 def load_embedding_model(model_name: str, device: str | None = None) -> SentenceTransformer:
-    """Загружает и кэширует embedding-модель."""
+    """
+    Загружает и кэширует embedding-модель. Если задан EMBEDDING_SERVER_URL,
+    возвращает клиент внешнего сервера инференса вместо локальной модели.
+    """
+    server_url = os.getenv("EMBEDDING_SERVER_URL")
+    if server_url:
+        print(f"Embedding-модель {model_name} обслуживается сервером инференса: {server_url}")
+        return RemoteEmbedder(server_url, model_name, timeout=float(os.getenv("INFERENCE_SERVER_TIMEOUT", "30")))
+
     device_to_use = device or "cpu"
     print(
         f"Загружаю embedding модель: {model_name} на устройство {device_to_use} (это может занять время)..."
     )
+    onnx_path = os.getenv("EMBEDDING_ONNX_PATH")
+    if onnx_path:
+        if os.getenv("EMBEDDING_INT8", "false").lower() in ("1", "true"):
+            onnx_path = _quantized_onnx_path(onnx_path)
+        model = OnnxEmbedder(
+            onnx_path, model_name, device=device_to_use,
+            pooling=os.getenv("EMBEDDING_ONNX_POOLING", "cls"),
+        )
+        print(f"Embedding-модель загружена из ONNX: {onnx_path}")
+        return model
     model = SentenceTransformer(model_name, device=device_to_use)
+    # Требуется Rust-токенизатор: медленный Python-токенизатор заметен при кодировании предложений ответа.
+    # В sentence-transformers 2.x у конструктора нет tokenizer_kwargs, поэтому токенизатор заменяется после загрузки
+    if not getattr(model.tokenizer, "is_fast", False):
+        from transformers import AutoTokenizer
+
+        model.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
     print("Embedding-модель успешно загружена.")
-    return model
\ No newline at end of file
+    return model
+
+def load_reranker_model(model_name: str, device: str | None = None) -> CrossEncoder:
+    """
+    Загружает реранкер-модель (CrossEncoder) с быстрым токенизатором. Если задан
+    RERANKER_SERVER_URL, возвращает клиент внешнего сервера инференса.
+    """
+    server_url = os.getenv("RERANKER_SERVER_URL")
+    if server_url:
+        print(f"Реранкер-модель {model_name} обслуживается сервером инференса: {server_url}")
+        return RemoteReranker(server_url, model_name, timeout=float(os.getenv("INFERENCE_SERVER_TIMEOUT", "30")))
+
+    device_to_use = device or "cpu"
+    print(f"Загрузка реранкер-модели: {model_name} на устройство '{device_to_use}'...")
+    onnx_path = os.getenv("RERANKER_ONNX_PATH")
+    if onnx_path:
+        if os.getenv("RERANKER_INT8", "false").lower() in ("1", "true"):
+            onnx_path = _quantized_onnx_path(onnx_path)
+        model = OnnxCrossEncoder(
+            onnx_path, model_name, device=device_to_use,
+            token_cache_size=int(os.getenv("RERANKER_TOKEN_CACHE_SIZE", "50000")),
+        )
+        print(f"Реранкер-модель загружена из ONNX: {onnx_path}")
+        return model
+    model = CrossEncoder(model_name, device=device_to_use, tokenizer_args={"use_fast": True})
+    print("Реранкер-модель успешно загружена.")
+    return model
+
+# Длины последовательностей (в токенах), на которых прогреваются модели на GPU
+WARMUP_SEQ_BUCKETS: Tuple[int, ...] = (32, 64, 128)
+
+def warmup_models(
+    embedding_model: Optional[SentenceTransformer],
+    reranker_model: Optional[CrossEncoder],
+    device: str,
+) -> Tuple[int, ...]:
+    """
+    Прогревает модели до первого запроса: на любом устройстве выполняется короткий
+    прогон (ленивая инициализация, JIT для MPS/CUDA), а на GPU дополнительно
+    прогоняется фиксированный набор длин входа, чтобы кэширующий аллокатор CUDA
+    и выбор ядер cuBLAS были готовы заранее.
+    Возвращает список прогретых длин (пустой, если устройство не CUDA).
+    """
+    # Модели на сервере инференса прогревает сам сервер
+    if isinstance(embedding_model, RemoteEmbedder):
+        embedding_model = None
+    if isinstance(reranker_model, RemoteReranker):
+        reranker_model = None
+    if embedding_model is None and reranker_model is None:
+        return ()
+
+    batch_size = int(os.getenv("WARMUP_BATCH_SIZE", "8"))
+    with torch.inference_mode():
+        if embedding_model is not None:
+            embedding_model.encode(["warmup"] * batch_size, batch_size=batch_size, show_progress_bar=False)
+        if reranker_model is not None:
+            reranker_model.predict([("a", "b")] * batch_size, batch_size=batch_size, show_progress_bar=False)
+
+        if device != "cuda":
+            return ()
+
+        print(f"Прогрев моделей на GPU для длин {WARMUP_SEQ_BUCKETS} (batch={batch_size})...")
+        for seq_len in WARMUP_SEQ_BUCKETS:
+            dummy_text = " ".join(["warmup"] * seq_len)
+            if embedding_model is not None:
+                embedding_model.encode([dummy_text] * batch_size, batch_size=batch_size, show_progress_bar=False)
+            if reranker_model is not None:
+                reranker_model.predict(
+                    [(dummy_text, dummy_text)] * batch_size, batch_size=batch_size, show_progress_bar=False
+                )
+        torch.cuda.synchronize()
+    print("Прогрев моделей завершен.")
+    return WARMUP_SEQ_BUCKETS
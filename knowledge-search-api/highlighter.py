@@ -4,9 +4,10 @@
 # --------------------------------------------------------------------------
 import re
 from difflib import SequenceMatcher
-from typing import List, Dict
+from typing import List, Dict, Optional
 
-from sentence_transformers import SentenceTransformer, util
+import torch
+from sentence_transformers import SentenceTransformer
 
 from schemas import RetrievedChunk, HighlightedCitation
 
@@ -19,29 +20,79 @@ def _split_into_sentences(text: str) -> List[str]:
     sentences = re.split(r'(?<=[.?!])\s+', text)
     return [s.strip() for s in sentences if s.strip()]
 
+# Предложение ответа (до точки/вопроса/воскл. знака) вместе с его цитатой в конце
+_CITED_SENTENCE_RE = re.compile(r'([^.?!]+[.?!])\s*(\[(\d+(?:,\s*\d+)*)\])')
+
+def _encode_normalized(embedding_model: SentenceTransformer, texts: List[str]) -> torch.Tensor:
+    """Кодирует тексты одним батчем в нормализованные эмбеддинги на устройстве модели."""
+    with torch.inference_mode():
+        return embedding_model.encode(
+            texts, batch_size=64, convert_to_tensor=True,
+            normalize_embeddings=True, show_progress_bar=False,
+        )
+
+def encode_chunk_texts(
+    source_chunks: List[RetrievedChunk], embedding_model: SentenceTransformer
+) -> Dict[int, torch.Tensor]:
+    """
+    Заранее кодирует тексты найденных чанков (по source_id), чтобы при верификации
+    кодировать только предложения ответа. Вызывается параллельно с генерацией LLM.
+    """
+    if not source_chunks:
+        return {}
+    embeddings = _encode_normalized(embedding_model, [chunk.text for chunk in source_chunks])
+    return {chunk.source_id: embeddings[i] for i, chunk in enumerate(source_chunks)}
+
+def _similarity_matrix(sentence_emb: torch.Tensor, chunk_emb: torch.Tensor) -> torch.Tensor:
+    """
+    Косинусная схожесть всех предложений ответа со всеми чанками одним матричным
+    умножением (эмбеддинги уже нормализованы). На GPU умножение идет в fp16.
+    """
+    with torch.inference_mode():
+        if sentence_emb.is_cuda:
+            sentence_emb, chunk_emb = sentence_emb.half(), chunk_emb.half()
+        return (sentence_emb @ chunk_emb.T).float().cpu()
+
 def verify_and_highlight_citations(
     answer_text: str,
     source_chunks: List[RetrievedChunk],
     embedding_model: SentenceTransformer,
-    similarity_threshold: float = 0.7
+    similarity_threshold: float = 0.7,
+    chunk_embeddings: Optional[Dict[int, torch.Tensor]] = None,
 ) -> tuple[str, List[HighlightedCitation]]:
     """
     Верифицирует цитаты в ответе, удаляет недостоверные,
     подсвечивает достоверные и возвращает очищенный текст и цитаты.
+    chunk_embeddings — эмбеддинги из encode_chunk_texts; если переданы, чанки повторно не кодируются.
     """
     source_map: Dict[int, RetrievedChunk] = {chunk.source_id: chunk for chunk in source_chunks}
     highlighted_texts: Dict[int, str] = {chunk.source_id: chunk.text for chunk in source_chunks}
     
     # Извлекаем все предложения и их цитаты из ответа
-    # Regex, который находит предложение (до точки/вопроса/воскл. знака) вместе с его цитатой в конце
-    pattern = re.compile(r'([^.?!]+[.?!])\s*(\[(\d+(?:,\s*\d+)*)\])')
-    
-    matches = pattern.findall(answer_text)
+    matches = [
+        (sentence.strip(), full_citation_marker, citation_ids_str)
+        for sentence, full_citation_marker, citation_ids_str in _CITED_SENTENCE_RE.findall(answer_text)
+    ]
     
     verified_answer_text = answer_text
+
+    # Верификация: схожесть считается сразу для всех пар (предложение, чанк)
+    sentence_index = {sentence: i for i, sentence in enumerate(dict.fromkeys(m[0] for m in matches))}
+    chunk_index = {source_id: i for i, source_id in enumerate(source_map)}
+    similarities = None
+    if sentence_index and chunk_index:
+        try:
+            sentence_emb = _encode_normalized(embedding_model, list(sentence_index))
+            if chunk_embeddings is not None and all(sid in chunk_embeddings for sid in source_map):
+                chunk_emb = torch.stack([chunk_embeddings[sid] for sid in source_map])
+            else:
+                chunk_emb = _encode_normalized(embedding_model, [chunk.text for chunk in source_map.values()])
+            similarities = _similarity_matrix(sentence_emb, chunk_emb)
+        except Exception as e:
+            print(f"Warning: Could not compute similarity for verification. Error: {e}")
+            similarities = None # Считаем, что верификация не пройдена
     
     for sentence, full_citation_marker, citation_ids_str in matches:
-        sentence = sentence.strip()
         source_ids = [int(sid.strip()) for sid in citation_ids_str.split(',')]
         
         is_verified = False
@@ -50,15 +101,10 @@ def verify_and_highlight_citations(
                 continue
 
             chunk_text = source_map[source_id].text
-            
-            # Верификация: вычисляем семантическую схожесть
-            try:
-                sentence_embedding = embedding_model.encode(sentence)
-                chunk_embedding = embedding_model.encode(chunk_text)
-                similarity = util.cos_sim(sentence_embedding, chunk_embedding).item()
-            except Exception as e:
-                print(f"Warning: Could not compute similarity for verification. Error: {e}")
-                similarity = 0.0 # Считаем, что верификация не пройдена
+            similarity = (
+                similarities[sentence_index[sentence], chunk_index[source_id]].item()
+                if similarities is not None else 0.0
+            )
 
             if similarity >= similarity_threshold:
                 is_verified = True
@@ -84,10 +130,8 @@ def verify_and_highlight_citations(
 
     # Формируем финальный список цитат
     final_citations = [
-        HighlightedCitation(
-            highlighted_text=highlighted_texts.get(chunk.source_id, chunk.text),
-            **chunk.dict(exclude={"metadata"}) # metadata не нужна в финальном ответе
-        ) for chunk in source_chunks
+        HighlightedCitation.from_chunk(chunk, highlighted_texts.get(chunk.source_id, chunk.text))
+        for chunk in source_chunks
     ]
         
     return verified_answer_text.strip(), final_citations
\ No newline at end of file
@@ -10,7 +10,28 @@ import psycopg2.extras
 from fastapi import HTTPException, status
 
 from clients import PostgreSQLClient
-from schemas import AnswerResponse
+from schemas import AnswerResponse, HISTORY_ADDED_COLUMNS, HISTORY_TABLES_DDL
+
+
+def ensure_history_schema(db: PostgreSQLClient) -> None:
+    """
+    Создает таблицы истории и добавляет недостающие колонки. Существующие колонки
+    определяются одним запросом к information_schema, ALTER выполняется только для отсутствующих.
+    """
+    tables = sorted({table for table, _ in HISTORY_ADDED_COLUMNS})
+    with db.get_cursor() as cur:
+        cur.execute(HISTORY_TABLES_DDL)
+        cur.execute(
+            """
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ANY(%s)
+            """,
+            (tables,),
+        )
+        existing = set(cur.fetchall())
+        for (table, column), column_type in HISTORY_ADDED_COLUMNS.items():
+            if (table, column) not in existing:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}")
 
 
 def get_or_create_conversation(
@@ -74,23 +95,29 @@ def save_search_result(
     user_id: Optional[str] = None,
     org_id: Optional[str] = None,
 ):
+    # Запрос и результат пишутся одним CTE-выражением: один round-trip к БД вместо двух.
     with db.get_cursor() as cur:
         try:
-            cur.execute(
-                "INSERT INTO search_queries (conversation_id, user_id, org_id, query) VALUES (%s, %s, %s, %s) RETURNING id",
-                (conv_id, user_id, org_id, query),
-            )
-            query_id = cur.fetchone()[0]
-
             cur.execute(
                 """
+                WITH new_query AS (
+                    INSERT INTO search_queries (conversation_id, user_id, org_id, query)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING id
+                )
                 INSERT INTO search_results (
                     query_id, user_id, org_id, answer, success, citations, graph_context, graph_status,
                     enrichment_used, used_chunks, used_tokens, latency_ms
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                )
+                SELECT new_query.id, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                FROM new_query
+                RETURNING query_id
                 """,
                 (
-                    query_id,
+                    conv_id,
+                    user_id,
+                    org_id,
+                    query,
                     user_id,
                     org_id,
                     response.answer,
@@ -104,6 +131,7 @@ def save_search_result(
                     response.latency_ms,
                 ),
             )
+            query_id = cur.fetchone()[0]
             print(f"Результат для query_id {query_id} успешно сохранен в историю.")
         except Exception as exc:
             # get_cursor сам обработает rollback
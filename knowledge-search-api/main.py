@@ -1,32 +1,44 @@
 import os
 import json
 import time
+import asyncio
 import uvicorn
+import orjson
 import torch
 import re
-from fastapi import Depends, FastAPI, Request, Response, status as http_status, HTTPException
-from fastapi.responses import StreamingResponse
+try:
+    # RE2 (DFA, линейное время без backtracking) — опционально; иначе стандартный re
+    import re2 as _citation_re_engine
+except ImportError:
+    _citation_re_engine = re
+from fastapi import BackgroundTasks, Depends, FastAPI, Request, Response, status as http_status, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from contextlib import asynccontextmanager
-from typing import Generator, List
+from decimal import Decimal
+from typing import Dict, Generator, List
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer, CrossEncoder
+from sentence_transformers import SentenceTransformer
 
 # --- Локальные модули ---
 from schemas import (
-    AnswerRequest, AnswerResponse, HISTORY_TABLES_DDL,
-    InternalChunk, HighlightedCitation, StreamTextChunk, StreamMetadataChunk,
+    AnswerRequest, AnswerResponse, AnswerResponseFrame, CITATIONS_ADAPTER,
+    InternalChunk, HighlightedCitation, StreamTextFrame, StreamMetadataFrame, STREAM_ENCODER,
     ConversationInfo, FullHistoryResponse, TokenIdentity
 )
-from clients import PostgreSQLClient, Neo4jClient, load_embedding_model
+from clients import (
+    PostgreSQLClient, Neo4jClient, RemoteEmbedder, RemoteReranker,
+    load_embedding_model, load_reranker_model, warmup_models
+)
 from retrieval import retrieve, retrieve_graph
 from context_builder import build_context
 from llm_provider import generate_answer, generate_answer_stream
 from history import (
-    get_or_create_conversation, get_conversation_history, save_search_result,
+    ensure_history_schema, get_or_create_conversation, get_conversation_history, save_search_result,
     get_history_list_for_user, get_full_history_by_query_id
 )
-from highlighter import verify_and_highlight_citations
+from highlighter import encode_chunk_texts, verify_and_highlight_citations
 from health_services import check_postgresql, check_neo4j, check_ollama
 from auth import get_token_identity
 
@@ -44,6 +56,11 @@ async def lifespan(app: FastAPI):
     else:
         device = "cpu"
     print(f"INFO:     Выбрано устройство для моделей: {device}")
+    # Сервис только выполняет инференс: градиенты не нужны, на Ampere+ matmul в fp32 идет через TF32.
+    # Режим градиентов локален для потока, поэтому вызовы моделей в пуле потоков
+    # дополнительно обернуты в torch.inference_mode().
+    torch.set_grad_enabled(False)
+    torch.set_float32_matmul_precision("high")
     
     db_params = {
         "host": os.getenv("DB_HOST"), "port": os.getenv("DB_PORT"),
@@ -68,13 +85,13 @@ async def lifespan(app: FastAPI):
 
     app.state.reranker_model = None
     if os.getenv("RERANKER_ENABLED", "false").lower() == 'true':
-        reranker_name = os.getenv("RERANKER_MODEL_NAME")
-        print(f"INFO:     Загрузка реранкер-модели: {reranker_name} на устройство '{device}'...")
-        app.state.reranker_model = CrossEncoder(reranker_name, device=device)
-        print("INFO:     Реранкер-модель успешно загружена.")
+        app.state.reranker_model = load_reranker_model(os.getenv("RERANKER_MODEL_NAME"), device=device)
+
+    app.state.encoder_warm_buckets = warmup_models(
+        app.state.embedding_model, app.state.reranker_model, device
+    )
     
-    with app.state.db_client.get_cursor() as cur:
-        cur.execute(HISTORY_TABLES_DDL)
+    ensure_history_schema(app.state.db_client)
     print("INFO:     Таблицы истории поиска проверены/созданы.")
     
     print("INFO:     Все ресурсы успешно инициализированы.")
@@ -83,16 +100,31 @@ async def lifespan(app: FastAPI):
     
     print("INFO:     Событие 'shutdown': закрытие ресурсов...")
     if hasattr(app.state, 'neo4j_client') and app.state.neo4j_client:
-        app.state.neo4j_client.close()
+        await app.state.neo4j_client.close()
     if hasattr(app.state, 'db_client') and app.state.db_client:
         app.state.db_client.close()
+    for model in (app.state.embedding_model, app.state.reranker_model):
+        if isinstance(model, (RemoteEmbedder, RemoteReranker)):
+            model.close()
     print("INFO:     Все ресурсы успешно освобождены.")
 
+def _orjson_default(value):
+    """Типы, которые orjson не сериализует сам (datetime и UUID он поддерживает нативно)."""
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+class AppJSONResponse(ORJSONResponse):
+    """JSON-ответ через orjson с поддержкой Decimal."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
 app = FastAPI(
     title="Knowledge Search API",
     description="API для интеллектуального поиска по базе знаний.",
     version="1.7.0", # Обновляем версию
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=AppJSONResponse,
 )
 
 # --- Настройка CORS Middleware ---
@@ -112,32 +144,168 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Сжатие ответов ---
+class SSEAwareGZipMiddleware:
+    """
+    GZip для обычных JSON-ответов. Запросы, ожидающие SSE (Accept: text/event-stream),
+    проходят мимо GZip: иначе токены буферизуются компрессором и стрим перестает быть потоковым.
+    """
+    def __init__(self, app, **gzip_options):
+        self.app = app
+        self.gzip_app = GZipMiddleware(app, **gzip_options)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"accept" and b"text/event-stream" in value:
+                    await self.app(scope, receive, send)
+                    return
+        await self.gzip_app(scope, receive, send)
+
+app.add_middleware(
+    SSEAwareGZipMiddleware,
+    minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", "1024")),
+    compresslevel=int(os.getenv("GZIP_COMPRESS_LEVEL", "5")),
+)
+
 # --- Вспомогательная функция ---
+# Маркеры цитат вида [1] или [2, 3] в тексте ответа
+_CITATION_RE = _citation_re_engine.compile(r'\[(\d+(?:,\s*\d+)*)\]')
+_INT_RE = _citation_re_engine.compile(r'\d+')
+
+def _extract_citation_ids(answer_text: str) -> set[int]:
+    """Возвращает номера источников, на которые ссылается текст ответа."""
+    used_ids = set()
+    for match in _CITATION_RE.finditer(answer_text):
+        used_ids.update(map(int, _INT_RE.findall(match.group(1))))
+    return used_ids
+
 def _filter_used_citations(answer_text: str, all_citations: List[HighlightedCitation]) -> List[HighlightedCitation]:
     """Фильтрует список цитат, оставляя только те, на которые есть ссылки в тексте ответа."""
-    used_ids = set()
-    matches = re.findall(r'\[(\d+(?:,\s*\d+)*)\]', answer_text)
-    for match in matches:
-        ids = [int(sid.strip()) for sid in match.split(',')]
-        used_ids.update(ids)
-    return sorted([c for c in all_citations if c.source_id in used_ids], key=lambda c: c.source_id)
+    used_ids = _extract_citation_ids(answer_text)
+    by_id = {c.source_id: c for c in all_citations}
+    return [by_id[sid] for sid in sorted(used_ids) if sid in by_id]
+
+def _precompute_chunk_embeddings(retrieved_chunks: List[InternalChunk], embedding_model: SentenceTransformer):
+    """Кодирует чанки для верификации цитат; при ошибке верификация закодирует их сама."""
+    try:
+        return encode_chunk_texts(retrieved_chunks, embedding_model)
+    except Exception as e:
+        print(f"Warning: Could not precompute chunk embeddings. Error: {e}")
+        return None
+
+def _verify_cited_chunks(
+    answer_text: str, retrieved_chunks: List[InternalChunk], embedding_model: SentenceTransformer,
+    chunk_embeddings=None,
+) -> tuple[str, List[HighlightedCitation]]:
+    """
+    Верифицирует только те чанки, на которые ссылается ответ: неупомянутые чанки
+    все равно отбрасываются _filter_used_citations, а без маркеров [n] проверять нечего.
+    """
+    used_ids = _extract_citation_ids(answer_text)
+    if not used_ids:
+        return answer_text.strip(), []
+    cited_chunks = [chunk for chunk in retrieved_chunks if chunk.source_id in used_ids]
+    return verify_and_highlight_citations(answer_text, cited_chunks, embedding_model, chunk_embeddings=chunk_embeddings)
 
 
 def _build_citation_fallback(retrieved_chunks: List[InternalChunk]) -> tuple[str, List[HighlightedCitation]]:
     """Возвращает безопасный fallback-ответ и список цитат, если Ollama/LLM недоступен."""
-    fallback_answer = "Не удалось сгенерировать сводный ответ, но вот наиболее релевантные фрагменты:\n\n"
-    citations_for_response = [
-        HighlightedCitation(highlighted_text=chunk.text, **chunk.dict(exclude={"metadata"}))
-        for chunk in retrieved_chunks
-    ]
-    for citation in citations_for_response:
-        fallback_answer += f"**[Источник {citation.source_id}: {citation.filename}]**\n{citation.highlighted_text}\n\n"
-    return fallback_answer, citations_for_response
+    citations_for_response = [HighlightedCitation.from_chunk(chunk, chunk.text) for chunk in retrieved_chunks]
+    parts = ["Не удалось сгенерировать сводный ответ, но вот наиболее релевантные фрагменты:\n\n"]
+    parts.extend(
+        f"**[Источник {citation.source_id}: {citation.filename}]**\n{citation.highlighted_text}\n\n"
+        for citation in citations_for_response
+    )
+    return "".join(parts), citations_for_response
+
+# --- SSE-кадры ---
+# Кадры кодируются msgspec-структурами сразу в bytes, без pydantic;
+# токены копятся в буфере и отправляются пачкой раз в N токенов или T миллисекунд.
+SSE_FLUSH_TOKENS = int(os.getenv("SSE_FLUSH_TOKENS", "8"))
+SSE_FLUSH_INTERVAL_S = int(os.getenv("SSE_FLUSH_INTERVAL_MS", "50")) / 1000
+
+def _sse_frame(payload) -> bytes:
+    """Оборачивает закодированную msgspec-структуру в SSE-кадр."""
+    return b"data: " + STREAM_ENCODER.encode(payload) + b"\n\n"
+
+def _sse_text_frame(content: str) -> bytes:
+    """Формирует SSE-кадр, эквивалентный StreamTextChunk(content=...)."""
+    return _sse_frame(StreamTextFrame(content=content))
+
+def _answer_response(response: AnswerResponse, citations_json: List[Dict]) -> Response:
+    """
+    Кодирует ответ /v1/answer msgspec-структурой прямо в bytes, минуя jsonable_encoder
+    и сериализацию pydantic; цитаты передаются уже сериализованными (те же, что пишутся в историю).
+    """
+    body = STREAM_ENCODER.encode(AnswerResponseFrame(
+        answer=response.answer,
+        conversation_id=response.conversation_id,
+        citations=citations_json,
+        graph_context=response.graph_context,
+        graph_status=response.graph_status,
+        enrichment_used=response.enrichment_used,
+        used_chunks=response.used_chunks,
+        used_tokens=response.used_tokens,
+        latency_ms=response.latency_ms,
+    ))
+    return Response(content=body, media_type="application/json")
+
+# Цитаты кадра метаданных кодируются по одной и отправляются порциями не меньше этого размера
+SSE_METADATA_FLUSH_BYTES = int(os.getenv("SSE_METADATA_FLUSH_BYTES", "16384"))
+
+_SSE_METADATA_PREFIX = b'{"type":"metadata",'
+
+def _sse_metadata_frames(metadata: StreamMetadataFrame, citations_json: List[Dict]) -> Generator[bytes, None, None]:
+    """
+    Отдает кадр метаданных частями: сначала открывается массив citations, затем цитаты
+    дописываются в буфер и сбрасываются по мере заполнения, в конце — скалярные поля.
+    Весь кадр остается одним SSE-событием ({"type": "metadata", "citations": [...], ...}),
+    "type" по-прежнему идет первым полем.
+    """
+    buffer = bytearray(b"data: " + _SSE_METADATA_PREFIX + b'"citations":[')
+    for i, citation in enumerate(citations_json):
+        if i:
+            buffer += b","
+        buffer += STREAM_ENCODER.encode(citation)
+        if len(buffer) >= SSE_METADATA_FLUSH_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    # msgspec пишет тег первым: {"type":"metadata",<поля>} — подставляем поля после массива
+    buffer += b"]," + STREAM_ENCODER.encode(metadata)[len(_SSE_METADATA_PREFIX):] + b"\n\n"
+    yield bytes(buffer)
+
+async def _resolved(value):
+    """Готовый результат для ветки, которую не нужно выполнять в asyncio.gather."""
+    return value
+
+# Ссылки на фоновые задачи записи истории, чтобы их не собрал GC до завершения
+_background_writes: set = set()
+
+def _schedule_history_write(*args, **kwargs) -> None:
+    """Запускает save_search_result в пуле потоков, не блокируя отдачу ответа клиенту."""
+    task = asyncio.create_task(asyncio.to_thread(save_search_result, *args, **kwargs))
+    _background_writes.add(task)
+    task.add_done_callback(_background_writes.discard)
+
+def _release_task(task: asyncio.Task) -> None:
+    """
+    Отменяет фоновую задачу, результат которой не понадобился (fallback, ошибка, разрыв стрима).
+    Ссылка держится в _background_writes до завершения, исключение задачи считается полученным.
+    """
+    task.cancel()
+    _background_writes.add(task)
+    task.add_done_callback(_consume_task_result)
+
+def _consume_task_result(task: asyncio.Task) -> None:
+    _background_writes.discard(task)
+    if not task.cancelled():
+        task.exception()
 
 # --- Эндпоинты API ---
 
-@app.post("/v1/answer", tags=["Search"])
-async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdentity = Depends(get_token_identity)):
+@app.post("/v1/answer", response_model=AnswerResponse, tags=["Search"])
+async def get_answer(req: AnswerRequest, request: Request, background: BackgroundTasks, identity: TokenIdentity = Depends(get_token_identity)):
     start_time = time.time()
     
     db_client = request.app.state.db_client
@@ -152,23 +320,27 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
         org_id=identity.org_id,
         first_query=req.query,
     )
-    conversation_history = get_conversation_history(db_client, conv_id)
 
-    graph_context_str, graph_status = "", "disabled"
-    if "graph" in req.mode:
-        if neo4j_client:
-            graph_context_str = retrieve_graph(neo4j_client, req.query, req.graph_depth)
-            graph_status = "ok" if graph_context_str else "empty"
-        else:
-            graph_status = "unavailable"
+    graph_status = "disabled"
+    run_graph = "graph" in req.mode and neo4j_client is not None
+    if "graph" in req.mode and not neo4j_client:
+        graph_status = "unavailable"
 
-    retrieved_chunks: List[InternalChunk] = []
     text_search_mode = req.mode.replace("+graph", "")
-    if text_search_mode in ["dense", "bm25", "hybrid"]:
-        retrieved_chunks = retrieve(
+    run_text_search = text_search_mode in ["dense", "bm25", "hybrid"]
+
+    # История диалога, граф и текстовый поиск не зависят друг от друга: выполняем их параллельно
+    conversation_history, graph_context_str, retrieved_chunks = await asyncio.gather(
+        asyncio.to_thread(get_conversation_history, db_client, conv_id),
+        retrieve_graph(neo4j_client, req.query, req.graph_depth) if run_graph else _resolved(""),
+        asyncio.to_thread(
+            retrieve,
             mode=text_search_mode, db_client=db_client, embedding_model=embedding_model,
             reranker_model=reranker_model, query=req.query, top_k=req.top_k, filters=req.filters
-        )
+        ) if run_text_search else _resolved([]),
+    )
+    if run_graph:
+        graph_status = "ok" if graph_context_str else "empty"
 
     if not retrieved_chunks and not graph_context_str:
         final_answer = "К сожалению, в базе знаний не найдено релевантной информации по вашему запросу."
@@ -177,7 +349,8 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
             answer=final_answer, conversation_id=conv_id, citations=[], graph_status=graph_status,
             enrichment_used=False, used_chunks=0, used_tokens=0, latency_ms=latency
         )
-        save_search_result(
+        background.add_task(
+            save_search_result,
             db_client,
             conv_id,
             req.query,
@@ -187,50 +360,77 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
             user_id=identity.user_id,
             org_id=identity.org_id,
         )
-        return response_data
+        return _answer_response(response_data, [])
         
     context_data = build_context(retrieved_chunks, conversation_history, graph_context_str)
 
+    # Эмбеддинги чанков для верификации цитат считаются в фоне, пока LLM генерирует ответ
+    chunk_embeddings_task = asyncio.create_task(
+        asyncio.to_thread(_precompute_chunk_embeddings, retrieved_chunks, embedding_model)
+    )
+
     if req.stream:
-        async def stream_generator():
+        async def _stream_answer():
             full_answer = ""
             stream_error = None
             citations_for_response: List[HighlightedCitation] = []
 
+            pending_tokens: List[str] = []
+            last_flush = time.monotonic()
+
             try:
                 for token in generate_answer_stream(
                     query=req.query, context=context_data["context_str"],
                     history_str=context_data["history_str"], max_tokens=req.max_tokens
                 ):
                     full_answer += token
-                    yield f"data: {StreamTextChunk(content=token).json()}\n\n"
+                    pending_tokens.append(token)
+                    now = time.monotonic()
+                    if len(pending_tokens) >= SSE_FLUSH_TOKENS or now - last_flush >= SSE_FLUSH_INTERVAL_S:
+                        yield _sse_text_frame("".join(pending_tokens))
+                        pending_tokens.clear()
+                        last_flush = now
             except Exception as exc:
                 stream_error = exc
                 print(f"Streaming generation failed, using fallback: {exc}")
 
+            if pending_tokens:
+                yield _sse_text_frame("".join(pending_tokens))
+
             if stream_error or not full_answer.strip():
                 full_answer, citations_for_response = _build_citation_fallback(retrieved_chunks)
                 for chunk in full_answer.split("\n\n"):
                     if chunk.strip():
-                        yield f"data: {StreamTextChunk(content=chunk + '\n\n').json()}\n\n"
+                        yield _sse_text_frame(chunk + "\n\n")
 
             is_success = not stream_error and bool(full_answer.strip())
-            verified_answer, all_highlighted = verify_and_highlight_citations(full_answer, retrieved_chunks, embedding_model) if is_success else (full_answer, citations_for_response)
+            verified_answer, all_highlighted = _verify_cited_chunks(
+                full_answer, retrieved_chunks, embedding_model, await chunk_embeddings_task
+            ) if is_success else (full_answer, citations_for_response)
             final_citations = citations_for_response if not is_success else _filter_used_citations(verified_answer, all_highlighted)
             latency = int((time.time() - start_time) * 1000)
 
-            metadata_chunk = StreamMetadataChunk(
-                conversation_id=conv_id, citations=final_citations,
-                graph_context=[{"content": graph_context_str}] if graph_context_str else None,
+            # Цитаты сериализуются один раз: для кадра метаданных и для записи в историю
+            history_citations_json = CITATIONS_ADAPTER.dump_python(final_citations, mode="json")
+            graph_context = [{"content": graph_context_str}] if graph_context_str else None
+            metadata = StreamMetadataFrame(
+                conversation_id=conv_id, graph_context=graph_context,
                 graph_status=graph_status, enrichment_used=context_data["enrichment_used"],
                 used_chunks=context_data["used_chunks"], used_tokens=context_data["used_tokens"],
                 latency_ms=latency
             )
-            yield f"data: {metadata_chunk.json()}\n\n"
+            for part in _sse_metadata_frames(metadata, history_citations_json):
+                yield part
 
-            final_response = AnswerResponse(answer=verified_answer or "Failed to generate stream.", **metadata_chunk.dict())
-            history_citations_json = [c.dict() for c in final_citations]
-            save_search_result(
+            # Все поля получены из внутреннего пайплайна — собираем ответ без валидации
+            final_response = AnswerResponse.model_construct(
+                answer=verified_answer or "Failed to generate stream.",
+                conversation_id=conv_id, citations=final_citations, graph_context=graph_context,
+                graph_status=graph_status, enrichment_used=context_data["enrichment_used"],
+                used_chunks=context_data["used_chunks"], used_tokens=context_data["used_tokens"],
+                latency_ms=latency,
+            )
+            _schedule_history_write(
                 db_client,
                 conv_id,
                 req.query,
@@ -241,22 +441,35 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
                 org_id=identity.org_id,
             )
 
+        async def stream_generator():
+            # Задача эмбеддингов освобождается и при fallback, и при разрыве соединения клиентом
+            try:
+                async for part in _stream_answer():
+                    yield part
+            finally:
+                _release_task(chunk_embeddings_task)
+
         return StreamingResponse(stream_generator(), media_type="text/event-stream")
 
     else:
         is_success = False
-        generated_answer = generate_answer(
-            query=req.query, context=context_data["context_str"],
-            history_str=context_data["history_str"], max_tokens=req.max_tokens
-        )
+        try:
+            generated_answer = generate_answer(
+                query=req.query, context=context_data["context_str"],
+                history_str=context_data["history_str"], max_tokens=req.max_tokens
+            )
 
-        if not generated_answer:
-            final_answer, citations_for_response = _build_citation_fallback(retrieved_chunks)
-            is_success = False
-        else:
-            final_answer, citations_for_response_all = verify_and_highlight_citations(generated_answer, retrieved_chunks, embedding_model)
-            citations_for_response = _filter_used_citations(final_answer, citations_for_response_all)
-            is_success = True
+            if not generated_answer:
+                final_answer, citations_for_response = _build_citation_fallback(retrieved_chunks)
+                is_success = False
+            else:
+                final_answer, citations_for_response_all = _verify_cited_chunks(
+                    generated_answer, retrieved_chunks, embedding_model, await chunk_embeddings_task
+                )
+                citations_for_response = _filter_used_citations(final_answer, citations_for_response_all)
+                is_success = True
+        finally:
+            _release_task(chunk_embeddings_task)
         
         latency = int((time.time() - start_time) * 1000)
         
@@ -268,8 +481,9 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
             latency_ms=latency
         )
         
-        history_citations_json = [c.dict() for c in citations_for_response]
-        save_search_result(
+        history_citations_json = CITATIONS_ADAPTER.dump_python(citations_for_response, mode="json")
+        background.add_task(
+            save_search_result,
             db_client,
             conv_id,
             req.query,
@@ -279,7 +493,7 @@ async def get_answer(req: AnswerRequest, request: Request, identity: TokenIdenti
             user_id=identity.user_id,
             org_id=identity.org_id,
         )
-        return response
+        return _answer_response(response, history_citations_json)
 
 @app.get("/health", tags=["Monitoring"])
 def health_check(request: Request, response: Response):
@@ -296,32 +510,47 @@ def health_check(request: Request, response: Response):
         
     return services_status
 
-@app.get("/v1/history", response_model=List[ConversationInfo], tags=["History"])
+# Ответы истории собираются из доверенных строк БД и отдаются через orjson без модели ответа
+# (datetime и UUID orjson сериализует сам); модели указаны в responses только для схемы OpenAPI.
+
+@app.get(
+    "/v1/history", response_model=None, tags=["History"],
+    responses={200: {"model": List[ConversationInfo]}},
+)
 async def get_history_list(limit: int = 20, offset: int = 0, request: Request = None, identity: TokenIdentity = Depends(get_token_identity)):
     db_client = request.app.state.db_client
     history_data = get_history_list_for_user(db_client, identity.user_id, identity.org_id, limit, offset)
-    return [
-        ConversationInfo(
-            conversation_id=str(row['conversation_id']), user_id=row['user_id'], org_id=row['org_id'],
-            title=row['title'], created_at=row['created_at']
-        ) for row in history_data
-    ]
-
-@app.get("/v1/history/{query_id}", response_model=FullHistoryResponse, tags=["History"])
+    return AppJSONResponse(content=[
+        {
+            "conversation_id": row['conversation_id'], "user_id": row['user_id'], "org_id": row['org_id'],
+            "title": row['title'], "created_at": row['created_at'],
+        } for row in history_data
+    ])
+
+@app.get(
+    "/v1/history/{query_id}", response_model=None, tags=["History"],
+    responses={200: {"model": FullHistoryResponse}},
+)
 async def get_history_details(query_id: int, request: Request = None, identity: TokenIdentity = Depends(get_token_identity)):
     db_client = request.app.state.db_client
     full_history = get_full_history_by_query_id(db_client, query_id, identity.user_id, identity.org_id)
 
     if not full_history:
         raise HTTPException(status_code=404, detail="Query ID not found")
-        
-    citations_data = full_history.get('citations') or []
-    full_history['citations'] = [HighlightedCitation(**c) for c in citations_data]
-    full_history['created_at'] = full_history['created_at']
-    full_history['conversation_id'] = str(full_history['conversation_id'])
-    
-    return FullHistoryResponse(**full_history)
+
+    # Поля строки совпадают с FullHistoryResponse; цитаты — JSONB, записанный этим же сервисом
+    full_history['citations'] = full_history['citations'] or []
+    return AppJSONResponse(content=full_history)
 
 if __name__ == "__main__":
     print("INFO:     Запуск FastAPI сервиса...")
-    uvicorn.run("main:app", host="0.0.0.0", port=8020, reload=True)
+    # reload несовместим с несколькими воркерами, поэтому включается только явно для разработки
+    reload = os.getenv("UVICORN_RELOAD", "false").lower() == 'true'
+    workers = 1 if reload else int(os.getenv("WEB_CONCURRENCY", "4"))
+    # uvloop/httptools недоступны под Windows — там uvicorn сам выберет asyncio/h11
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8020,
+        workers=workers, reload=reload,
+        loop="uvloop" if os.name != "nt" else "auto",
+        http="httptools" if os.name != "nt" else "auto",
+    )
@@ -1,8 +1,19 @@
 import os
+import asyncio
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import numpy as np
 import psycopg2.extras
-from collections import defaultdict
+import torch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from hashlib import blake2b
 from typing import List, Dict, Literal, Optional, Tuple
 
 from sentence_transformers import SentenceTransformer, CrossEncoder
@@ -14,41 +25,124 @@ import re
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
 
+# Общая HTTP-сессия к Ollama: keep-alive соединения переиспользуются между запросами,
+# короткий таймаут подключения позволяет быстро уйти в fallback, если Ollama недоступна
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=8, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2, allowed_methods=None),
+)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+_HTTP.mount("https://", _HTTP_ADAPTER)
+OLLAMA_TIMEOUT = (3, 60)
+
+# Очистка запроса для BM25 и эвристики извлечения сущностей, компилируются один раз при импорте
+_BM25_CLEAN_RE = re.compile(r'[^\w\s]+')
+_DOUBLE_QUOTED_RE = re.compile(r'"([^"]+)"')
+_SINGLE_QUOTED_RE = re.compile(r"'([^']+)'")
+_CAPITALIZED_WORD_RE = re.compile(r'[A-ZА-ЯЁ][\w-]{2,}')
+
 # --- Вспомогательные функции ---
 
-def _build_filter_clause(filters: Optional[Filters], doc_ids: Optional[List[str]] = None) -> Tuple[str, list]:
+@lru_cache(maxsize=256)
+def _filter_clause_for_shape(
+    has_doc_ids: bool, has_author: bool, has_date_from: bool, has_date_to: bool, has_doc_type: bool, has_space: bool
+) -> str:
+    """
+    Текст WHERE для набора заданных фильтров. Значения идут параметрами (списки — одним
+    массивом в ANY), поэтому текст зависит только от формы фильтров и строится один раз на форму;
+    одинаковый текст запроса позволяет переиспользовать подготовленный оператор.
+    """
     clauses = []
-    params = []
+    if has_doc_ids:
+        clauses.append("c.doc_id = ANY(%s)")
+    if has_author:
+        clauses.append("d.author ILIKE ANY(%s)")
+    if has_date_from:
+        clauses.append("d.uploaded_at >= %s")
+    if has_date_to:
+        clauses.append("d.uploaded_at <= %s")
+    if has_doc_type:
+        clauses.append("d.filename ILIKE ANY(%s)")
+    if has_space:
+        clauses.append("c.block_type = ANY(%s)")
+    return "WHERE " + " AND ".join(clauses) if clauses else ""
 
+def _build_filter_clause(filters: Optional[Filters], doc_ids: Optional[List[str]] = None) -> Tuple[str, list]:
+    # Параметры — в том же порядке, что и условия в _filter_clause_for_shape; списки всегда list
+    params = []
     if doc_ids:
-        clauses.append("c.doc_id = ANY(%s)")
-        params.append(doc_ids)
-        
-    if filters:
-        if filters.author:
-            clauses.append("d.author ILIKE ANY(%s)")
-            params.append(tuple(filters.author))
-
-        if filters.date_from:
-            clauses.append("d.uploaded_at >= %s")
-            params.append(filters.date_from)
-        if filters.date_to:
-            clauses.append("d.uploaded_at <= %s")
-            params.append(filters.date_to)
-
-        if filters.doc_type:
-            doc_type_clauses = [f"d.filename ILIKE %s" for _ in filters.doc_type]
-            clauses.append("(" + " OR ".join(doc_type_clauses) + ")")
-            params.extend([f"%.{dt.lstrip('.')}" for dt in filters.doc_type])
-            
-        if filters.space:
-            clauses.append("c.block_type = ANY(%s)")
-            params.append(tuple(filters.space))
-    
-    if not clauses:
-        return "", []
-    
-    return "WHERE " + " AND ".join(clauses), params
+        params.append(list(doc_ids))
+    if not filters:
+        return _filter_clause_for_shape(bool(doc_ids), False, False, False, False, False), params
+
+    if filters.author:
+        params.append(list(filters.author))
+    if filters.date_from:
+        params.append(filters.date_from)
+    if filters.date_to:
+        params.append(filters.date_to)
+    if filters.doc_type:
+        params.append([f"%.{dt.lstrip('.')}" for dt in filters.doc_type])
+    if filters.space:
+        params.append(list(filters.space))
+
+    clause = _filter_clause_for_shape(
+        bool(doc_ids), bool(filters.author), bool(filters.date_from), bool(filters.date_to),
+        bool(filters.doc_type), bool(filters.space),
+    )
+    return clause, params
+
+# Буквальные запросы (фраза в кавычках, имя файла, тег), для которых порядок первого этапа уже верен
+_LITERAL_QUERY_RE = re.compile(r'"[^"]+"|\'[^\']+\'|\S+\.\w{1,5}|#\w+')
+
+def _is_literal_query(query: str) -> bool:
+    """Проверяет, является ли запрос буквальным поиском, для которого реранкинг не нужен."""
+    return bool(_LITERAL_QUERY_RE.fullmatch(query.strip()))
+
+RERANK_BATCH = int(os.getenv("RERANK_BATCH", "32"))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", "900"))
+RERANK_CACHE_MAXSIZE = int(os.getenv("RERANK_CACHE_MAXSIZE", "100000"))
+
+# Кэш оценок реранкера: (хэш запроса, doc_id, chunk_id) -> (score, время записи).
+# OrderedDict хранит ключи в порядке последнего использования (LRU), доступ — под блокировкой,
+# так как retrieve выполняется в пуле потоков.
+_rerank_cache: "OrderedDict[tuple, Tuple[float, float]]" = OrderedDict()
+_rerank_cache_lock = threading.Lock()
+
+def _rerank_cache_key(query_hash: bytes, chunk: InternalChunk) -> tuple:
+    return (query_hash, chunk.doc_id, chunk.chunk_id)
+
+def _rerank_cache_get(keys: List[tuple]) -> List[Optional[float]]:
+    now = time.monotonic()
+    scores: List[Optional[float]] = []
+    with _rerank_cache_lock:
+        for key in keys:
+            entry = _rerank_cache.get(key)
+            if entry is None or now - entry[1] > RERANK_CACHE_TTL:
+                scores.append(None)
+                continue
+            _rerank_cache.move_to_end(key)
+            scores.append(entry[0])
+    return scores
+
+def _rerank_cache_put(items: List[Tuple[tuple, float]]) -> None:
+    now = time.monotonic()
+    with _rerank_cache_lock:
+        for key, score in items:
+            _rerank_cache[key] = (score, now)
+            _rerank_cache.move_to_end(key)
+        while len(_rerank_cache) > RERANK_CACHE_MAXSIZE:
+            _rerank_cache.popitem(last=False)
+
+def _top_k_by_score(chunks: List[InternalChunk], scores: np.ndarray, top_k: int) -> List[InternalChunk]:
+    """Возвращает top_k чанков по убыванию score без полной сортировки всех кандидатов."""
+    if top_k < len(chunks):
+        top = np.argpartition(-scores, top_k)[:top_k]
+    else:
+        top = np.arange(len(chunks))
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [chunks[i] for i in top]
 
 def _rerank_results(reranker_model: Optional[CrossEncoder], query: str, chunks: List[InternalChunk], top_k: int) -> List[InternalChunk]:
     if not chunks:
@@ -56,74 +150,116 @@ def _rerank_results(reranker_model: Optional[CrossEncoder], query: str, chunks:
     if not reranker_model:
         return sorted(chunks, key=lambda c: c.score, reverse=True)[:top_k]
 
-    print(f"Reranking: Переранжирование {len(chunks)} кандидатов...")
-    pairs = [[query, chunk.text] for chunk in chunks]
-    scores = reranker_model.predict(pairs, show_progress_bar=False)
+    # Оценки уже встречавшихся пар (запрос, чанк) берутся из кэша, модель считает только промахи
+    query_hash = blake2b(query.encode(), digest_size=16).digest()
+    keys = [_rerank_cache_key(query_hash, chunk) for chunk in chunks]
+    cached = _rerank_cache_get(keys) if RERANK_CACHE_TTL > 0 else [None] * len(chunks)
+    scores = np.array([np.nan if score is None else score for score in cached], dtype=np.float32)
+    misses = [i for i, score in enumerate(cached) if score is None]
+
+    print(f"Reranking: Переранжирование {len(chunks)} кандидатов ({len(chunks) - len(misses)} из кэша)...")
+    if misses:
+        # Пары сортируются по длине текста, чтобы в батче было минимум паддинга
+        order = np.array(sorted(misses, key=lambda i: len(chunks[i].text)), dtype=np.intp)
+        sorted_pairs = [[query, chunks[i].text] for i in order]
+        with torch.inference_mode():
+            scores_sorted = np.asarray(
+                reranker_model.predict(
+                    sorted_pairs, batch_size=RERANK_BATCH, show_progress_bar=False, convert_to_numpy=True
+                ),
+                dtype=np.float32,
+            )
+        scores[order] = scores_sorted
+        if RERANK_CACHE_TTL > 0:
+            _rerank_cache_put([(keys[i], float(scores[i])) for i in order])
     
     for chunk, score in zip(chunks, scores):
         chunk.score = float(score)
         
-    return sorted(chunks, key=lambda c: c.score, reverse=True)[:top_k]
+    return _top_k_by_score(chunks, scores, top_k)
+
+def _format_table(rows: List[Dict], fallback_text: str) -> str:
+    """Собирает текст таблицы из ее фрагментов (строк chunks, упорядоченных по chunk_id)."""
+    if not rows: return fallback_text
+
+    if all(r['type'] == 'table_row' for r in rows):
+        try:
+            headers = [item.split(':')[0].strip() for item in rows[0]['text'].split(', ')]
+            md_lines = [
+                "| " + " | ".join(headers) + " |",
+                "| " + " | ".join(["---"] * len(headers)) + " |",
+            ]
+            for row in rows:
+                values = [item.split(':', 1)[1].strip() for item in row['text'].split(', ')]
+                md_lines.append("| " + " | ".join(values) + " |")
+            return "\n".join(md_lines) + "\n"
+        except IndexError:
+            return "\n".join([row['text'] for row in rows])
+    elif any((r.get('block_type') or '').startswith('table') for r in rows):
+        combined_lines = []
+        seen_data_rows = set()
 
-def _find_and_reconstruct_table(db_client: PostgreSQLClient, chunk: InternalChunk) -> str:
-    sql = "SELECT text, type, block_type FROM chunks WHERE doc_id = %s AND section = %s AND (type LIKE 'table%%' OR block_type LIKE 'table%%') ORDER BY chunk_id;"
-    
-    with db_client.get_cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute(sql, (chunk.doc_id, chunk.section))
-        rows = cur.fetchall()
-        if not rows: return chunk.text
-
-        if all(r['type'] == 'table_row' for r in rows):
-            try:
-                headers = [item.split(':')[0].strip() for item in rows[0]['text'].split(', ')]
-                md_table = "| " + " | ".join(headers) + " |\n"
-                md_table += "| " + " | ".join(["---"] * len(headers)) + " |\n"
-                for row in rows:
-                    values = [item.split(':', 1)[1].strip() for item in row['text'].split(', ')]
-                    md_table += "| " + " | ".join(values) + " |\n"
-                return md_table
-            except IndexError:
-                return "\n".join([row['text'] for row in rows])
-        elif any((r.get('block_type') or '').startswith('table') for r in rows):
-            combined_lines = []
-            seen_data_rows = set()
+        for row in rows:
+            lines = row['text'].split("\n") if row['text'] else []
+            if not lines:
+                continue
 
-            for row in rows:
-                lines = row['text'].split("\n") if row['text'] else []
-                if not lines:
-                    continue
+            header = lines[0]
+            separator = lines[1] if len(lines) > 1 else None
+            data_lines = lines[2:] if len(lines) > 2 else []
 
-                header = lines[0]
-                separator = lines[1] if len(lines) > 1 else None
-                data_lines = lines[2:] if len(lines) > 2 else []
+            if not combined_lines:
+                combined_lines.append(header)
+                if separator:
+                    combined_lines.append(separator)
 
-                if not combined_lines:
-                    combined_lines.append(header)
-                    if separator:
-                        combined_lines.append(separator)
+            for data_line in data_lines:
+                if data_line not in seen_data_rows:
+                    combined_lines.append(data_line)
+                    seen_data_rows.add(data_line)
 
-                for data_line in data_lines:
-                    if data_line not in seen_data_rows:
-                        combined_lines.append(data_line)
-                        seen_data_rows.add(data_line)
+        return "\n".join(combined_lines) if combined_lines else fallback_text
+    else:
+        return "\n".join([row['text'] for row in rows])
 
-            return "\n".join(combined_lines) if combined_lines else chunk.text
-        else:
-            return "\n".join([row['text'] for row in rows])
+_TABLE_FRAGMENT_TYPES = ('table_part', 'table_row', 'table_cell')
 
-def _post_process_chunks(db_client: PostgreSQLClient, chunks: List[InternalChunk]) -> List[InternalChunk]:
+def _with_table_fragments(top_sql: str) -> str:
+    """
+    Оборачивает поисковый запрос в CTE и для каждого фрагмента таблицы тем же запросом
+    подтягивает все фрагменты этой таблицы (упорядоченные по chunk_id) в колонку table_fragments.
+    """
+    return f"""
+        WITH top AS ({top_sql})
+        SELECT top.*, tf.table_fragments
+        FROM top
+        LEFT JOIN LATERAL (
+            SELECT jsonb_agg(
+                       jsonb_build_object('text', f.text, 'type', f.type, 'block_type', f.block_type)
+                       ORDER BY f.chunk_id
+                   ) AS table_fragments
+            FROM chunks f
+            WHERE top.type IN ('table_part', 'table_row', 'table_cell')
+              AND f.doc_id = top.doc_id AND f.section = top.section
+              AND (f.type LIKE 'table%%' OR f.block_type LIKE 'table%%')
+        ) tf ON TRUE
+        ORDER BY top.score DESC;
+    """
+
+def _post_process_chunks(chunks: List[InternalChunk]) -> List[InternalChunk]:
+    # Фрагменты таблиц уже получены поисковым запросом (см. _with_table_fragments)
     final_blocks = []
     processed_objects = set()
 
     for chunk in chunks:
-        is_table_fragment = chunk.type in ['table_part', 'table_row', 'table_cell']
+        is_table_fragment = chunk.type in _TABLE_FRAGMENT_TYPES
         if is_table_fragment:
             if not chunk.section:
                 final_blocks.append(chunk)
                 continue
             table_key = (chunk.doc_id, chunk.section)
             if table_key not in processed_objects:
-                full_table_text = _find_and_reconstruct_table(db_client, chunk)
+                full_table_text = _format_table(chunk.table_fragments or [], chunk.text)
                 chunk.text = f"[Из таблицы '{chunk.section}']:\n{full_table_text}"
                 chunk.block_type = "reconstructed_table"
                 final_blocks.append(chunk)
@@ -135,33 +271,70 @@ def _post_process_chunks(db_client: PostgreSQLClient, chunks: List[InternalChunk
 
 # --- Основные методы поиска (Retrieval) ---
 
-def retrieve_dense(db_client: PostgreSQLClient, embedding_model: SentenceTransformer, query: str, top_k: int, filters: Optional[Filters], allowed_doc_ids: Optional[List[str]]) -> List[InternalChunk]:
-    query_embedding = embedding_model.encode(query)
+# Размер списка кандидатов при обходе HNSW (больше — точнее, но медленнее); 0 — значение сервера
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "0"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+class _ModelKey:
+    """Хэшируемая по идентичности обертка модели — ключ для lru_cache."""
+    __slots__ = ("model",)
+
+    def __init__(self, model):
+        self.model = model
+
+    def __hash__(self):
+        return id(self.model)
+
+    def __eq__(self, other):
+        return isinstance(other, _ModelKey) and other.model is self.model
+
+@lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _encode_query_cached(query: str, model_key: _ModelKey) -> np.ndarray:
+    with torch.inference_mode():
+        embedding = np.asarray(model_key.model.encode(query), dtype=np.float32)
+    embedding.setflags(write=False) # Один массив отдается всем запросам из кэша
+    return embedding
+
+def _encode_query(query: str, embedding_model: SentenceTransformer) -> np.ndarray:
+    """Эмбеддинг запроса; повторы того же запроса (ретраи, пагинация) берутся из кэша."""
+    return _encode_query_cached(query, _ModelKey(embedding_model))
+
+def retrieve_dense(db_client: PostgreSQLClient, embedding_model: SentenceTransformer, query: str, top_k: int, filters: Optional[Filters], allowed_doc_ids: Optional[List[str]], query_embedding: Optional[np.ndarray] = None) -> List[InternalChunk]:
+    if query_embedding is None:
+        query_embedding = _encode_query(query, embedding_model)
     filter_clause, params = _build_filter_clause(filters, allowed_doc_ids)
     
-    sql_query = f"""
+    # Сортировка идет по тому же выражению, что и в HNSW-индексе ix_chunks_embedding_hnsw,
+    # поэтому планировщик обходит индекс вместо полного перебора; score считается только для top_k.
+    # Размерность в выражении индекса берется из схемы БД при старте (см. PostgreSQLClient.embedding_dim)
+    embedding_dim = db_client.embedding_dim
+    if embedding_dim:
+        distance_expr = f"c.embedding::halfvec({embedding_dim}) <=> %s::halfvec({embedding_dim})"
+    else:
+        distance_expr = "c.embedding <=> %s::vector"
+    sql_query = _with_table_fragments(f"""
         SELECT c.doc_id, c.chunk_id, c.text, c.section, d.filename, c.metadata, c.type, c.block_type,
-               1 - (c.embedding::vector <=> %s::vector) AS score
+               1 - ({distance_expr}) AS score
         FROM chunks c JOIN documents d ON c.doc_id = d.doc_id
-        {filter_clause} ORDER BY score DESC LIMIT %s;
-    """
+        {filter_clause} ORDER BY {distance_expr} LIMIT %s
+    """)
+    embedding_param = query_embedding
     
     results = []
-    with db_client.get_cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute(sql_query, params + [query_embedding.tolist(), top_k])
+    with db_client.get_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        if HNSW_EF_SEARCH:
+            cur.execute("SET LOCAL hnsw.ef_search = %s", (HNSW_EF_SEARCH,))
+        db_client.execute_prepared(cur, sql_query, [embedding_param] + params + [embedding_param, top_k])
         rows = cur.fetchall()
-        for row in rows:
-            results.append(InternalChunk(source_id=-1, **row))
+        # Строки БД уже имеют нужные типы — собираем чанки без валидации pydantic
+        results = [InternalChunk.model_construct(source_id=-1, **row) for row in rows]
     return results
 
 def retrieve_bm25(db_client: PostgreSQLClient, query: str, top_k: int, filters: Optional[Filters], allowed_doc_ids: Optional[List[str]]) -> List[InternalChunk]:
     # --- НОВАЯ ЛОГИКА ОЧИСТКИ ---
-    # 1. Оставляем только буквы, цифры и пробелы
-    clean_query = re.sub(r'[^\w\s]', '', query)
-    # 2. Разбиваем на слова и отбрасываем пустые
-    words = [word for word in clean_query.strip().split() if word]
-    # 3. Объединяем через '&' для tsquery
-    ts_query = " & ".join(words)
+    # Оставляем только буквы, цифры и пробелы, разбиваем на слова (split() сам отбрасывает пустые)
+    # и объединяем через '&' для tsquery
+    ts_query = " & ".join(_BM25_CLEAN_RE.sub('', query).split())
 
     if not ts_query: # Если после очистки ничего не осталось
         print("BM25 search skipped: query is empty after cleaning.")
@@ -170,46 +343,66 @@ def retrieve_bm25(db_client: PostgreSQLClient, query: str, top_k: int, filters:
     filter_clause, params = _build_filter_clause(filters, allowed_doc_ids)
     where_conjunction = "AND" if filter_clause else "WHERE"
     
-    sql_query = f"""
+    sql_query = _with_table_fragments(f"""
         SELECT c.doc_id, c.chunk_id, c.text, c.section, d.filename, c.metadata, c.type, c.block_type,
                ts_rank(c.text_tsv, to_tsquery('russian', %s)) as score
         FROM chunks c JOIN documents d ON c.doc_id = d.doc_id
         {filter_clause} {where_conjunction} c.text_tsv @@ to_tsquery('russian', %s)
-        ORDER BY score DESC LIMIT %s;
-    """
+        ORDER BY score DESC LIMIT %s
+    """)
     
     results = []
-    with db_client.get_cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute(sql_query, params + [ts_query, ts_query, top_k])
+    with db_client.get_cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        db_client.execute_prepared(cur, sql_query, [ts_query] + params + [ts_query, top_k])
         rows = cur.fetchall()
-        for row in rows:
-            results.append(InternalChunk(source_id=-1, **row))
+        # Строки БД уже имеют нужные типы — собираем чанки без валидации pydantic
+        results = [InternalChunk.model_construct(source_id=-1, **row) for row in rows]
     return results
 
-def retrieve_hybrid(db_client: PostgreSQLClient, embedding_model: SentenceTransformer, query: str, top_k: int, filters: Optional[Filters], allowed_doc_ids: Optional[List[str]]) -> List[InternalChunk]:
-    dense_results = retrieve_dense(db_client, embedding_model, query, top_k, filters, allowed_doc_ids)
-    bm25_results = retrieve_bm25(db_client, query, top_k, filters, allowed_doc_ids)
+# Пул для BM25-ветки гибридного поиска: она идет по отдельному соединению из пула БД,
+# пока текущий поток кодирует запрос и выполняет dense-поиск
+_HYBRID_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HYBRID_SEARCH_WORKERS", "8")), thread_name_prefix="bm25"
+)
 
-    k = 60
-    rrf_scores = defaultdict(float)
-    
-    for rank, chunk in enumerate(dense_results):
-        rrf_scores[(chunk.doc_id, chunk.chunk_id)] += 1 / (k + rank + 1)
+def retrieve_hybrid(db_client: PostgreSQLClient, embedding_model: SentenceTransformer, query: str, top_k: int, filters: Optional[Filters], allowed_doc_ids: Optional[List[str]], query_embedding: Optional[np.ndarray] = None) -> List[InternalChunk]:
+    bm25_future = _HYBRID_EXECUTOR.submit(retrieve_bm25, db_client, query, top_k, filters, allowed_doc_ids)
+    dense_results = retrieve_dense(db_client, embedding_model, query, top_k, filters, allowed_doc_ids, query_embedding)
+    bm25_results = bm25_future.result()
 
-    for rank, chunk in enumerate(bm25_results):
-        rrf_scores[(chunk.doc_id, chunk.chunk_id)] += 1 / (k + rank + 1)
-        
-    all_chunks = { (c.doc_id, c.chunk_id): c for c in dense_results + bm25_results }
-    sorted_chunk_ids = sorted(rrf_scores.keys(), key=lambda cid: rrf_scores[cid], reverse=True)
-    
-    candidates = [all_chunks[cid] for cid in sorted_chunk_ids]
-    for c in candidates:
-        c.score = rrf_scores.get((c.doc_id, c.chunk_id), 0.0)
+    k = 60
+    # RRF за один проход по обеим выдачам (без их конкатенации): каждому (doc_id, chunk_id)
+    # присваивается индекс в порядке первого появления, вклады рангов суммируются np.bincount
+    index: Dict[Tuple[str, int], int] = {}
+    unique_chunks: List[InternalChunk] = []
+    inverse = np.empty(len(dense_results) + len(bm25_results), dtype=np.intp)
+    for pos, c in enumerate(chain(dense_results, bm25_results)):
+        i = index.setdefault((c.doc_id, c.chunk_id), len(index))
+        if i == len(unique_chunks):
+            unique_chunks.append(c)
+        inverse[pos] = i
+    if not index:
+        return []
+    weights = np.concatenate([
+        1 / (k + np.arange(1, len(dense_results) + 1, dtype=np.float64)),
+        1 / (k + np.arange(1, len(bm25_results) + 1, dtype=np.float64)),
+    ])
+    rrf_scores = np.bincount(inverse, weights=weights, minlength=len(index))
+
+    # Возвращается весь объединенный список: реранкер видит всех кандидатов обеих выдач,
+    # а до top_k список сокращает _rerank_results. Сортировка стабильна — при равных
+    # оценках сохраняется порядок первого появления
+    order = np.argsort(-rrf_scores, kind="stable")
+
+    candidates = [unique_chunks[i] for i in order]
+    for c, i in zip(candidates, order):
+        c.score = float(rrf_scores[i])
         
     return candidates
 
 # --- "Фасадная" функция для текстового поиска ---
 SearchMode = Literal["dense", "bm25", "hybrid"]
+DOC_PREFILTER_ENABLED = os.getenv("DOC_PREFILTER_ENABLED", "false").lower() == 'true'
 
 def retrieve(
     mode: SearchMode,
@@ -221,9 +414,12 @@ def retrieve(
     filters: Optional[Filters]
 ) -> List[InternalChunk]:
     
-    # Пре-фильтрация по метаданным документов
+    # Фильтры по автору/дате документа применяются в основном запросе через JOIN documents.
+    # Отдельная пре-фильтрация (лишний запрос и список doc_id на клиенте) оставлена только
+    # как запасной вариант за флагом DOC_PREFILTER_ENABLED.
     allowed_doc_ids = None
-    if filters and (filters.author or filters.date_from or filters.date_to):
+    chunk_filters = filters
+    if DOC_PREFILTER_ENABLED and filters and (filters.author or filters.date_from or filters.date_to):
         doc_filters_only = Filters(author=filters.author, date_from=filters.date_from, date_to=filters.date_to)
         doc_filter_clause, doc_params = _build_filter_clause(doc_filters_only)
         doc_filter_clause = doc_filter_clause.replace("d.", "")
@@ -232,22 +428,29 @@ def retrieve(
             cur.execute(f"SELECT doc_id FROM documents {doc_filter_clause}", doc_params)
             allowed_doc_ids = [row[0] for row in cur.fetchall()]
             if not allowed_doc_ids: return []
+        chunk_filters = Filters(doc_type=filters.doc_type, space=filters.space)
 
     candidate_k = top_k * 5 if reranker_model else top_k
-    chunk_filters = Filters(doc_type=filters.doc_type if filters else None, space=filters.space if filters else None)
     
+    # Запрос кодируется один раз и передается в dense-ветку
+    query_embedding = _encode_query(query, embedding_model) if mode in ("dense", "hybrid") else None
+
     candidates: List[InternalChunk] = []
     if mode == "dense":
-        candidates = retrieve_dense(db_client, embedding_model, query, candidate_k, chunk_filters, allowed_doc_ids)
+        candidates = retrieve_dense(db_client, embedding_model, query, candidate_k, chunk_filters, allowed_doc_ids, query_embedding)
     elif mode == "bm25":
         candidates = retrieve_bm25(db_client, query, candidate_k, chunk_filters, allowed_doc_ids)
     elif mode == "hybrid":
-        candidates = retrieve_hybrid(db_client, embedding_model, query, candidate_k, chunk_filters, allowed_doc_ids)
+        candidates = retrieve_hybrid(db_client, embedding_model, query, candidate_k, chunk_filters, allowed_doc_ids, query_embedding)
     else:
         raise ValueError(f"Неизвестный режим поиска: {mode}")
 
-    reranked_chunks = _rerank_results(reranker_model, query, candidates, top_k)
-    reconstructed_chunks = _post_process_chunks(db_client, reranked_chunks)
+    if reranker_model and _is_literal_query(query):
+        print(f"Reranking: пропущен для буквального запроса '{query[:50]}'")
+        reranked_chunks = _rerank_results(None, query, candidates, top_k)
+    else:
+        reranked_chunks = _rerank_results(reranker_model, query, candidates, top_k)
+    reconstructed_chunks = _post_process_chunks(reranked_chunks)
         
     for i, chunk in enumerate(reconstructed_chunks):
         chunk.source_id = i + 1
@@ -264,48 +467,59 @@ def _extract_entities_from_query(query: str) -> List[str]:
     Query: "{query}"
     """
     try:
-        response = requests.post(OLLAMA_URL, json={
+        response = _HTTP.post(OLLAMA_URL, json={
             "model": OLLAMA_MODEL, "system": system_prompt, "prompt": user_prompt,
             "stream": False, "format": "json", "options": {"temperature": 0.0}
-        }, timeout=60)
+        }, timeout=OLLAMA_TIMEOUT)
         response.raise_for_status()
         entities = json.loads(response.json().get("response", "[]"))
         return [str(e) for e in entities if isinstance(e, str)]
     except Exception as e:
         print(f"Graph Entity Extraction Error: {e}")
         fallback_entities = set()
-        fallback_entities.update(re.findall(r'"([^"]+)"', query))
-        fallback_entities.update(re.findall(r"'([^']+)'", query))
-        fallback_entities.update([word for word in re.findall(r'[A-ZА-ЯЁ][\w-]{2,}', query)])
+        fallback_entities.update(_DOUBLE_QUOTED_RE.findall(query))
+        fallback_entities.update(_SINGLE_QUOTED_RE.findall(query))
+        fallback_entities.update(_CAPITALIZED_WORD_RE.findall(query))
         return list({e.strip(): None for e in fallback_entities if e.strip()}.keys())
 
-def retrieve_graph(neo4j_client: Neo4jClient, query: str, graph_depth: int) -> str:
+# Cypher-запросы обхода графа для каждой допустимой глубины. Глубину нельзя передать
+# параметром в шаблон пути, поэтому тексты строятся один раз: план каждого кэшируется Neo4j,
+# а в запрос не попадает ничего из пользовательского ввода
+_GRAPH_CYPHERS = {
+    depth: f"""
+        MATCH (e:Entity)
+        WHERE e.name IN $entities
+        MATCH path = (e)-[*1..{depth}]-(related)
+        UNWIND relationships(path) as r
+        RETURN DISTINCT r
+    """
+    for depth in range(1, 5)
+}
+
+async def retrieve_graph(neo4j_client: Neo4jClient, query: str, graph_depth: int) -> str:
     print(f"Выполняется graph поиск для запроса: '{query[:50]}...'")
-    if not neo4j_client or not neo4j_client.driver:
+    if not neo4j_client or not neo4j_client.async_driver:
         return ""
 
-    entities = _extract_entities_from_query(query)
+    cypher_query = _GRAPH_CYPHERS.get(graph_depth)
+    if cypher_query is None:
+        raise ValueError(f"Недопустимая глубина обхода графа: {graph_depth}")
+
+    # Извлечение сущностей — блокирующий HTTP-вызов к LLM, выносим его из event loop
+    entities = await asyncio.to_thread(_extract_entities_from_query, query)
     if not entities:
         return ""
 
     print(f"Найденные сущности для графа: {entities}")
     
-    cypher_query = f"""
-        MATCH (e:Entity)
-        WHERE e.name IN $entities
-        MATCH path = (e)-[*1..{graph_depth}]-(related)
-        UNWIND relationships(path) as r
-        RETURN DISTINCT r
-    """
-    
     verbalized_context = set()
-    with neo4j_client.driver.session() as session:
-        result = session.run(cypher_query, entities=entities)
-        for record in result:
+    async with neo4j_client.async_driver.session(database=neo4j_client.database) as session:
+        result = await session.run(cypher_query, entities=entities)
+        async for record in result:
             rel = record["r"]
             start_node = rel.start_node
             end_node = rel.end_node
             relation_type = rel.get("type", "RELATED_TO")
             verbalized_context.add(f"{start_node['name']} -> [{relation_type}] -> {end_node['name']}")
             
-    return "\n".join(sorted(list(verbalized_context)))
\ No newline at end of file
+    return "\n".join(sorted(list(verbalized_context)))
@@ -1,7 +1,19 @@
 from datetime import date, datetime
-from typing import Dict, List, Literal, Optional, Union
+from typing import Dict, List, Literal, NamedTuple, Optional, Union
+
+import msgspec
+from pydantic import BaseModel, Field, TypeAdapter
+from typing_extensions import TypedDict
+
+# Статус графового поиска в ответе: выключен, недоступен, найден контекст, контекст пуст
+GraphStatus = Literal["disabled", "unavailable", "ok", "empty"]
+
+
+class GraphContextItem(TypedDict):
+    """Элемент graph_context: вербализованные связи графа знаний."""
+
+    content: str
 
-from pydantic import BaseModel, Field
 
 # --- DDL для таблиц, которые создает и которыми владеет этот сервис ---
 
@@ -38,13 +50,17 @@ CREATE TABLE IF NOT EXISTS search_results (
     latency_ms INT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
-
-ALTER TABLE conversations ADD COLUMN IF NOT EXISTS org_id TEXT;
-ALTER TABLE search_queries ADD COLUMN IF NOT EXISTS org_id TEXT;
-ALTER TABLE search_results ADD COLUMN IF NOT EXISTS user_id TEXT;
-ALTER TABLE search_results ADD COLUMN IF NOT EXISTS org_id TEXT;
 """
 
+# Колонки, добавленные в таблицы истории после их первого создания: (таблица, колонка) -> тип.
+# ALTER TABLE берет ACCESS EXCLUSIVE даже при IF NOT EXISTS, поэтому выполняется только для отсутствующих.
+HISTORY_ADDED_COLUMNS = {
+    ("conversations", "org_id"): "TEXT",
+    ("search_queries", "org_id"): "TEXT",
+    ("search_results", "user_id"): "TEXT",
+    ("search_results", "org_id"): "TEXT",
+}
+
 # --- Модели для внутреннего использования ---
 
 
@@ -70,6 +86,8 @@ class InternalChunk(RetrievedChunk):
     section: Optional[str] = None
     block_type: Optional[str] = None
     metadata: Optional[Dict] = None
+    # Все фрагменты таблицы, к которой относится чанк (заполняется поисковым запросом)
+    table_fragments: Optional[List[Dict]] = None
 
 
 # --- Модели для API ---
@@ -87,6 +105,21 @@ class HighlightedCitation(BaseModel):
     highlighted_text: str
     score: float
 
+    # Конструкторы для доверенных внутренних данных: поля уже имеют нужные типы,
+    # поэтому модель собирается без валидации pydantic
+
+    @classmethod
+    def from_chunk(cls, chunk: RetrievedChunk, highlighted_text: str) -> "HighlightedCitation":
+        """Цитата из найденного чанка."""
+        return cls.model_construct(
+            source_id=chunk.source_id, doc_id=chunk.doc_id, chunk_id=chunk.chunk_id,
+            filename=chunk.filename, highlighted_text=highlighted_text, score=chunk.score,
+        )
+
+
+# Сериализатор списка цитат (для записи в JSONB истории), создается один раз при импорте
+CITATIONS_ADAPTER = TypeAdapter(List[HighlightedCitation])
+
 
 class Filters(BaseModel):
     """Модель для фильтров поиска."""
@@ -113,7 +146,7 @@ class AnswerRequest(BaseModel):
     context_mode: Literal["short", "long"] = Field(
         default="long", description="Режим контекста (пока не используется)."
     )
-    graph_depth: int = Field(default=2, description="Глубина обхода графа знаний.")
+    graph_depth: int = Field(default=2, ge=1, le=4, description="Глубина обхода графа знаний.")
     top_k: int = Field(
         default=10,
         description="Количество наиболее релевантных чанков для извлечения.",
@@ -131,8 +164,8 @@ class AnswerResponse(BaseModel):
     answer: str
     conversation_id: str
     citations: List[HighlightedCitation]
-    graph_context: Optional[List[Dict]] = None
-    graph_status: str
+    graph_context: Optional[List[GraphContextItem]] = None
+    graph_status: GraphStatus
     enrichment_used: bool
     used_chunks: int
     used_tokens: int
@@ -155,14 +188,57 @@ class StreamMetadataChunk(BaseModel):
     type: Literal["metadata"] = "metadata"
     conversation_id: str
     citations: List[HighlightedCitation]
-    graph_context: Optional[List[Dict]] = None
-    graph_status: str
+    graph_context: Optional[List[GraphContextItem]] = None
+    graph_status: GraphStatus
     enrichment_used: bool
     used_chunks: int
     used_tokens: int
     latency_ms: int
 
 
+# Wire-структуры ответов на msgspec: кодируются прямо в bytes без промежуточного dict.
+# Формат JSON совпадает с StreamTextChunk/StreamMetadataChunk ("type" идет первым полем).
+
+
+class StreamTextFrame(msgspec.Struct, tag_field="type", tag="text"):
+    """msgspec-аналог StreamTextChunk."""
+
+    content: str
+
+
+class StreamMetadataFrame(msgspec.Struct, kw_only=True, tag_field="type", tag="metadata"):
+    """
+    Скалярные поля кадра метаданных (msgspec-аналог StreamMetadataChunk без цитат):
+    массив citations дописывается в тот же JSON-объект потоково, по одной цитате.
+    """
+
+    conversation_id: str
+    graph_context: Optional[List[GraphContextItem]] = None
+    graph_status: GraphStatus
+    enrichment_used: bool
+    used_chunks: int
+    used_tokens: int
+    latency_ms: int
+
+
+class AnswerResponseFrame(msgspec.Struct, kw_only=True):
+    """msgspec-аналог AnswerResponse для тела не-стримингового ответа /v1/answer."""
+
+    answer: str
+    conversation_id: str
+    citations: List[Dict]
+    graph_context: Optional[List[GraphContextItem]] = None
+    graph_status: GraphStatus
+    enrichment_used: bool
+    used_chunks: int
+    used_tokens: int
+    latency_ms: int
+
+
+# Общий кодировщик msgspec-структур (SSE-кадры и тело ответа /v1/answer)
+STREAM_ENCODER = msgspec.json.Encoder()
+
+
 # --- Модели для API Истории ---
 
 
@@ -187,8 +263,8 @@ class FullHistoryResponse(BaseModel):
     answer: str
     success: bool
     citations: List[HighlightedCitation]
-    graph_context: Optional[List[Dict]] = None
-    graph_status: str
+    graph_context: Optional[List[GraphContextItem]] = None
+    graph_status: GraphStatus
     enrichment_used: bool
     used_chunks: int
     used_tokens: int
@@ -196,8 +272,8 @@ class FullHistoryResponse(BaseModel):
     created_at: datetime
 
 
-class TokenIdentity(BaseModel):
-    """Распакованные данные токена OIDC."""
+class TokenIdentity(NamedTuple):
+    """Распакованные данные токена OIDC (внутренний контейнер, без валидации pydantic)."""
 
     user_id: str
     org_id: Optional[str] = None
@@ -0,0 +1,129 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+TEST_ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(TEST_ROOT))
+
+import retrieval
+from retrieval import _format_table, _is_literal_query, _post_process_chunks
+from schemas import InternalChunk
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        '"регламент закупок"',
+        "'Положение о премировании'",
+        "report_2024.pdf",
+        "  приказ-15.docx  ",
+        "#onboarding",
+    ],
+)
+def test_literal_queries_skip_rerank(query):
+    assert _is_literal_query(query)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "как оформить отпуск",
+        '"регламент" закупок',
+        "что написано в report.pdf про бюджет",
+        "#onboarding новых сотрудников",
+        "",
+    ],
+)
+def test_free_text_queries_are_reranked(query):
+    assert not _is_literal_query(query)
+
+
+def test_format_table_builds_markdown_from_table_rows():
+    rows = [
+        {"text": "Имя: Иван, Отдел: Продажи", "type": "table_row", "block_type": None},
+        {"text": "Имя: Анна, Отдел: Финансы", "type": "table_row", "block_type": None},
+    ]
+
+    assert _format_table(rows, "fallback") == (
+        "| Имя | Отдел |\n"
+        "| --- | --- |\n"
+        "| Иван | Продажи |\n"
+        "| Анна | Финансы |\n"
+    )
+
+
+def test_format_table_merges_table_parts_without_duplicate_rows():
+    rows = [
+        {"text": "| A | B |\n| --- | --- |\n| 1 | 2 |", "type": "table_part", "block_type": "table_part"},
+        {"text": "| A | B |\n| --- | --- |\n| 1 | 2 |\n| 3 | 4 |", "type": "table_part", "block_type": "table_part"},
+    ]
+
+    assert _format_table(rows, "fallback") == "| A | B |\n| --- | --- |\n| 1 | 2 |\n| 3 | 4 |"
+
+
+def test_format_table_falls_back_to_chunk_text_without_rows():
+    assert _format_table([], "исходный текст") == "исходный текст"
+
+
+def test_post_process_chunks_reconstructs_each_table_once():
+    fragments = [
+        {"text": "Имя: Иван, Отдел: Продажи", "type": "table_row", "block_type": None},
+        {"text": "Имя: Анна, Отдел: Финансы", "type": "table_row", "block_type": None},
+    ]
+    chunks = [
+        InternalChunk(
+            source_id=-1, doc_id="doc1", chunk_id=chunk_id, filename="staff.xlsx", text=fragment["text"],
+            score=1.0, type="table_row", section="Сотрудники", table_fragments=fragments,
+        )
+        for chunk_id, fragment in enumerate(fragments)
+    ]
+    chunks.append(
+        InternalChunk(
+            source_id=-1, doc_id="doc1", chunk_id=5, filename="staff.xlsx", text="Обычный абзац",
+            score=0.5, type="paragraph",
+        )
+    )
+
+    result = _post_process_chunks(chunks)
+
+    assert [chunk.chunk_id for chunk in result] == [0, 5]
+    assert result[0].block_type == "reconstructed_table"
+    assert result[0].text.startswith("[Из таблицы 'Сотрудники']:\n| Имя | Отдел |")
+    assert result[1].text == "Обычный абзац"
+
+
+class _RecordingReranker:
+    def __init__(self):
+        self.pair_counts = []
+
+    def predict(self, pairs, **_kwargs):
+        self.pair_counts.append(len(pairs))
+        return np.arange(len(pairs), dtype=np.float32)
+
+
+def _paragraph(chunk_id):
+    return InternalChunk(
+        source_id=-1, doc_id="doc1", chunk_id=chunk_id, filename="doc.pdf", text=f"Абзац {chunk_id}",
+        score=0.0, type="paragraph",
+    )
+
+
+def test_hybrid_reranker_sees_every_fused_candidate(monkeypatch):
+    dense = [_paragraph(i) for i in range(0, 10)]
+    bm25 = [_paragraph(i) for i in range(5, 15)]
+    monkeypatch.setattr(retrieval, "RERANK_CACHE_TTL", 0)
+    monkeypatch.setattr(retrieval, "_encode_query", lambda query, model: None)
+    monkeypatch.setattr(retrieval, "retrieve_dense", lambda *args, **kwargs: list(dense))
+    monkeypatch.setattr(retrieval, "retrieve_bm25", lambda *args, **kwargs: list(bm25))
+    reranker = _RecordingReranker()
+
+    result = retrieval.retrieve(
+        mode="hybrid", db_client=None, embedding_model=None, reranker_model=reranker,
+        query="как оформить отпуск", top_k=2, filters=None,
+    )
+
+    # candidate_k = 10 из каждой выдачи, 5 общих: реранкер получает все 15 уникальных кандидатов
+    assert reranker.pair_counts == [15]
+    assert len(result) == 2
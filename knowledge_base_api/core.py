@@ -1,18 +1,22 @@
+import asyncio
 import datetime
+import time
 import uuid
-from typing import Annotated, Optional
+from typing import Annotated, Dict, Optional, Tuple
 
 import aioboto3
 import httpx
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwk, jwt
+from jose.backends.base import Key
+from jose.exceptions import JWKError
 from jose.utils import base64url_decode
-from passlib.context import CryptContext
 from pydantic_settings import BaseSettings
 from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from models import Organization, Tenant, User, UserRole
 
@@ -38,52 +42,105 @@ class Settings(BaseSettings):
     initial_tenant_name: str = "Default Tenant"
     require_authentication: bool = True
 
+    db_pool_size: int = 20
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 1800
+    # Отдельный небольшой пул (при наличии - к реплике) для /health и /status
+    read_database_url: Optional[str] = None
+    read_db_pool_size: int = 4
+    read_db_max_overflow: int = 2
+    # Период пересчета материализованного представления tenant_chunk_stats (счетчики /status)
+    tenant_chunk_stats_refresh_seconds: int = 60
+
     class Config:
         env_file = ".env"
         extra = "ignore"
 
 
 settings = Settings()
-engine = create_async_engine(settings.database_url, echo=False)
-AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+# Значения настроек, которые читаются на каждый запрос, фиксируются один раз при импорте
+_SECRET_KEY = settings.secret_key
+_ALGORITHM = settings.algorithm
+ACCESS_TOKEN_TTL_SECONDS = settings.access_token_expire_minutes * 60
+_REFRESH_TOKEN_TTL_SECONDS = settings.refresh_token_expire_minutes * 60
+_S3_CLIENT_KWARGS = dict(
+    endpoint_url=settings.s3_endpoint_url,
+    aws_access_key_id=settings.s3_access_key_id,
+    aws_secret_access_key=settings.s3_secret_access_key,
+    region_name=settings.s3_region,
+)
+# pool_pre_ping не включен: проверочный SELECT на каждую выдачу соединения не нужен,
+# разорванные соединения отсекает pool_recycle и keepalive на стороне сервера
+engine = create_async_engine(
+    settings.database_url,
+    echo=False,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=False,
+)
+# expire_on_commit=False: объекты остаются загруженными после commit, без ленивой догрузки атрибутов
+AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
+# Мониторинговые запросы не конкурируют с записью за соединения основного пула
+read_engine = create_async_engine(
+    settings.read_database_url or settings.database_url,
+    echo=False,
+    pool_size=settings.read_db_pool_size,
+    max_overflow=settings.read_db_max_overflow,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=False,
+)
+ReadSessionLocal = async_sessionmaker(read_engine, expire_on_commit=False, autoflush=False)
 s3_session = aioboto3.Session()
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# argon2-cffi напрямую: хэши в том же PHC-формате ($argon2id$...), что писал passlib
+pwd_context = PasswordHasher()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
-_jwks_cache: Optional[dict] = None
-_jwks_cached_at: Optional[datetime.datetime] = None
+# kid -> (ключ, разобранный один раз при обновлении JWKS; алгоритм подписи)
+_jwks_cache: Optional[Dict[str, Tuple[Key, str]]] = None
+_jwks_cached_at: Optional[float] = None  # time.monotonic() последнего обновления
+_jwks_lock = asyncio.Lock()
 _JWKS_TTL_SECONDS = 300
-
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    if hashed_password is None:
-        return False
-    return pwd_context.verify(plain_password, hashed_password)
+# Неизвестный kid (ротация ключей у IdP) вызывает внеплановое обновление не чаще этого интервала
+_JWKS_MIN_REFRESH_SECONDS = 30
+# Общий HTTP-клиент для запросов к IdP: соединение (TCP+TLS, HTTP/2) переиспользуется между обновлениями JWKS
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=4),
+)
+
+
+def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, bool]:
+    """Возвращает (пароль верен, хэш нужно пересчитать с текущими параметрами argon2)."""
+    if not hashed_password:
+        return False, False
+    try:
+        pwd_context.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False, False
+    return True, pwd_context.check_needs_rehash(hashed_password)
 
 
 def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta] = None) -> str:
     to_encode = data.copy()
-    expire = datetime.datetime.utcnow() + (
-        expires_delta or datetime.timedelta(minutes=settings.access_token_expire_minutes)
-    )
-    to_encode.update({"exp": expire, "type": "access"})
-    return jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
+    ttl = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_TTL_SECONDS
+    to_encode.update({"exp": int(time.time()) + ttl, "type": "access"})
+    return jwt.encode(to_encode, _SECRET_KEY, algorithm=_ALGORITHM)
 
 
 def create_refresh_token(data: dict, expires_delta: Optional[datetime.timedelta] = None) -> str:
     to_encode = data.copy()
-    expire = datetime.datetime.utcnow() + (
-        expires_delta or datetime.timedelta(minutes=settings.refresh_token_expire_minutes)
-    )
-    to_encode.update({"exp": expire, "type": "refresh"})
-    return jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
+    ttl = int(expires_delta.total_seconds()) if expires_delta else _REFRESH_TOKEN_TTL_SECONDS
+    to_encode.update({"exp": int(time.time()) + ttl, "type": "refresh"})
+    return jwt.encode(to_encode, _SECRET_KEY, algorithm=_ALGORITHM)
 
 
 def decode_token(token: str, expected_type: Optional[str] = None) -> dict:
     try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        payload = jwt.decode(token, _SECRET_KEY, algorithms=[_ALGORITHM])
     except JWTError as exc:  # noqa: BLE001
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -103,55 +160,89 @@ async def get_db() -> AsyncSession:
         yield session
 
 
+async def get_read_db() -> AsyncSession:
+    async with ReadSessionLocal() as session:
+        yield session
+
+
 async def get_s3_client():
-    async with s3_session.client(
-        "s3",
-        endpoint_url=settings.s3_endpoint_url,
-        aws_access_key_id=settings.s3_access_key_id,
-        aws_secret_access_key=settings.s3_secret_access_key,
-        region_name=settings.s3_region,
-    ) as s3:
+    async with s3_session.client("s3", **_S3_CLIENT_KWARGS) as s3:
         yield s3
 
 
 async def _fetch_jwks():
     if not settings.oidc_jwks_url:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="OIDC JWKS url is not configured")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(settings.oidc_jwks_url, timeout=10)
-        response.raise_for_status()
-        return response.json().get("keys", [])
+    response = await _http.get(settings.oidc_jwks_url)
+    response.raise_for_status()
+    return response.json().get("keys", [])
 
 
-async def _get_jwks():
+async def close_http_client() -> None:
+    await _http.aclose()
+
+
+def _parse_jwks(keys: list) -> Dict[str, Tuple[Key, str]]:
+    parsed = {}
+    for key_data in keys:
+        kid = key_data.get("kid")
+        if not kid or key_data.get("use", "sig") != "sig":
+            continue
+        algorithm = key_data.get("alg", "RS256")
+        try:
+            parsed[kid] = (jwk.construct(key_data, algorithm), algorithm)
+        except JWKError:
+            continue
+    return parsed
+
+
+def _jwks_age_seconds(now: float) -> Optional[float]:
+    if _jwks_cache is None or _jwks_cached_at is None:
+        return None
+    return now - _jwks_cached_at
+
+
+async def _get_jwks(force_refresh: bool = False) -> Dict[str, Tuple[Key, str]]:
     global _jwks_cache, _jwks_cached_at
-    now = datetime.datetime.utcnow()
-    if _jwks_cache and _jwks_cached_at and (now - _jwks_cached_at).total_seconds() < _JWKS_TTL_SECONDS:
+    age = _jwks_age_seconds(time.monotonic())
+    min_age = _JWKS_MIN_REFRESH_SECONDS if force_refresh else _JWKS_TTL_SECONDS
+    if age is not None and age < min_age:
+        return _jwks_cache
+    async with _jwks_lock:
+        # Пока ждали блокировку, ключи мог обновить другой запрос
+        age = _jwks_age_seconds(time.monotonic())
+        if age is not None and age < min_age:
+            return _jwks_cache
+        _jwks_cache = _parse_jwks(await _fetch_jwks())
+        _jwks_cached_at = time.monotonic()
         return _jwks_cache
-    _jwks_cache = await _fetch_jwks()
-    _jwks_cached_at = now
-    return _jwks_cache
 
 
-async def _get_signing_key(token: str):
+async def warmup_jwks() -> None:
+    """Загружает JWKS заранее (при старте приложения), а не на первом запросе с токеном."""
+    await _get_jwks()
+
+
+async def _get_signing_key(token: str) -> Tuple[Key, str]:
     headers = jwt.get_unverified_header(token)
     kid = headers.get("kid")
-    jwks = await _get_jwks()
-    for key in jwks:
-        if key.get("kid") == kid:
-            return key
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Signing key not found for token")
+    signing_key = (await _get_jwks()).get(kid)
+    if signing_key is None:
+        signing_key = (await _get_jwks(force_refresh=True)).get(kid)
+    if signing_key is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Signing key not found for token")
+    return signing_key
 
 
 async def validate_oidc_token(token: str) -> dict:
     if not (settings.oidc_client_id and settings.oidc_issuer and settings.oidc_jwks_url):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="OIDC is not configured")
     try:
-        signing_key = await _get_signing_key(token)
+        signing_key, algorithm = await _get_signing_key(token)
         payload = jwt.decode(
             token,
             signing_key,
-            algorithms=[signing_key.get("alg", "RS256")],
+            algorithms=[algorithm],
             audience=settings.oidc_client_id,
             issuer=settings.oidc_issuer,
         )
@@ -233,11 +324,18 @@ async def get_current_user(
         raise credentials_exception
 
     org_id = claims.get("org_id")
-    tenant_id = await resolve_tenant_id(db, org_id) if org_id else None
-
-    query = select(User).where(User.idp_subject == subject)
-    result = await db.execute(query)
-    user = result.scalars().first()
+    if org_id:
+        # Пользователь и tenant его организации — одним запросом вместо двух
+        query = (
+            select(User, Organization.tenant_id)
+            .outerjoin(Organization, Organization.id == uuid.UUID(org_id))
+            .where(User.idp_subject == subject)
+        )
+        row = (await db.execute(query)).first()
+        user, tenant_id = row if row else (None, None)
+    else:
+        result = await db.execute(select(User).where(User.idp_subject == subject))
+        user, tenant_id = result.scalars().first(), None
 
     if not user:
         raise credentials_exception
@@ -7,6 +7,8 @@ set -e
 echo "--- Running Database Initializer (Manual Mode) ---"
 python init_db.py
 echo "--- Database Initializer finished ---"
+# Схема готова: воркеры приложения не выполняют DDL при старте
+export SCHEMA_READY=1
 
 # Теперь передаем управление основной команде контейнера (uvicorn)
 exec "$@"
\ No newline at end of file
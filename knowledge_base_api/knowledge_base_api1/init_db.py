@@ -1,11 +1,9 @@
 import time
 import asyncio
-from sqlalchemy import inspect
 from sqlalchemy.ext.asyncio import create_async_engine
 
 # Импортируем необходимые компоненты из нашего основного приложения
-# Base содержит метаданные обо ВСЕХ наших таблицах (KnowledgeEvent и ApiLog)
-from main import Base, settings
+from main import initialize_database, settings
 
 async def check_and_init_db():
     print("--- Database Initializer (Manual Mode) ---")
@@ -33,36 +31,15 @@ async def check_and_init_db():
         print("[!] Could not connect to the database after several retries. Aborting.")
         exit(1)
 
-    # Проверяем наличие наших таблиц
-    tables_to_check = ["knowledge_events", "api_logs"]
-    missing_tables = []
-
-    async with engine.begin() as conn:
-        def check_tables_sync(sync_conn):
-            inspector = inspect(sync_conn)
-            non_existent = []
-            for table_name in tables_to_check:
-                if not inspector.has_table(table_name):
-                    non_existent.append(table_name)
-            return non_existent
-        
-        missing_tables = await conn.run_sync(check_tables_sync)
+    # Таблицы, расширения и начальные данные создаются одной идемпотентной функцией приложения,
+    # чтобы воркеры uvicorn не выполняли DDL при каждом старте (см. SCHEMA_READY).
+    try:
+        await initialize_database(engine)
+        print("[V] All tables created or verified successfully.")
+    except Exception as e:
+        print(f"[!] An error occurred while initializing the database: {e}")
+        exit(1)
 
-    if not missing_tables:
-        print("[V] All required tables already exist. No action needed.")
-    else:
-        print(f"[!] The following tables are missing: {', '.join(missing_tables)}")
-        print("[*] Creating all tables from metadata...")
-        try:
-            async with engine.begin() as conn:
-                # Base.metadata.create_all создаст ВСЕ таблицы,
-                # которые определены через Base, пропуская уже существующие.
-                await conn.run_sync(Base.metadata.create_all)
-            print("[V] All tables created or verified successfully.")
-        except Exception as e:
-            print(f"[!] An error occurred while creating tables: {e}")
-            exit(1)
-    
     # Закрываем соединение с движком
     await engine.dispose()
 
@@ -8,34 +8,60 @@
 # - Интеграцию с S3 (MinIO)
 # - Структурированное логирование и трассировку
 # - Глубокий Health Check
+#
+# Пул соединений БД настраивается через DB_POOL_SIZE, DB_MAX_OVERFLOW,
+# DB_POOL_TIMEOUT, DB_POOL_PRE_PING и DB_POOL_RECYCLE. При работе через PgBouncer
+# в режиме transaction задайте DB_USE_NULL_POOL=true: приложение не держит
+# собственный пул, мультиплексированием соединений занимается PgBouncer.
+#
+# Схема и начальные данные создаются скриптом init_db.py (docker-entrypoint.sh
+# запускает его до uvicorn и выставляет SCHEMA_READY=1). Без SCHEMA_READY
+# приложение, как и раньше, инициализирует БД само при старте - удобно для
+# локального запуска, но при нескольких воркерах это N параллельных DDL.
 # ===============================================================================
 
+import asyncio
+import copy
 import datetime
+import hashlib
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import time
 import uuid
 import enum
 from contextvars import ContextVar
 from logging.config import dictConfig
-from typing import List, Optional, Annotated
+from typing import Dict, List, Optional, Annotated, Tuple
+
+import orjson
+from pythonjsonlogger import jsonlogger
 
 # --- Core FastAPI & Pydantic Imports ---
 from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, Response, status, UploadFile
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
 # --- SQLAlchemy Imports ---
-from sqlalchemy import BigInteger, Column, DateTime, Integer, String, func, select, Boolean, ForeignKey, Index, text
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, func, select, insert, delete, Boolean, ForeignKey, Index, text
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.pool import NullPool
 
 # --- Security Imports ---
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 # --- S3 Imports ---
 import aioboto3
+import botocore.session
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 # ===============================================================================
@@ -46,6 +72,9 @@ class Settings(BaseSettings):
     database_url: str; s3_endpoint_url: Optional[str] = None; s3_access_key_id: str
     s3_secret_access_key: str; s3_bucket_name: str; s3_region: str; secret_key: str
     algorithm: str; access_token_expire_minutes: int
+    db_pool_size: int = 20; db_max_overflow: int = 20; db_pool_timeout: int = 30
+    db_pool_pre_ping: bool = True; db_pool_recycle: int = 1800; db_use_null_pool: bool = False
+    schema_ready: bool = False
     class Config:
         env_file = ".env"
         extra = "ignore" # Игнорируем лишние переменные из .env
@@ -58,15 +87,29 @@ class TraceIdFilter(logging.Filter):
         record.trace_id = trace_id_var.get()
         return True
 
+class OrjsonFormatter(jsonlogger.JsonFormatter):
+    # Сериализация записи одним вызовом orjson вместо json.dumps.
+    def jsonify_log_record(self, log_record):
+        return orjson.dumps(log_record, default=str, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z).decode()
+
+class StructuredQueueHandler(QueueHandler):
+    # Стандартный prepare() форматирует запись и вклеивает traceback в message; здесь только фиксируем
+    # текст сообщения и traceback (exc_text), а JSON собирает форматтер QueueListener с отдельным полем exc_info.
+    def prepare(self, record):
+        record = copy.copy(record); record.msg = record.getMessage(); record.args = None
+        if record.exc_info and not record.exc_text: record.exc_text = _exc_text_formatter.formatException(record.exc_info)
+        record.exc_info = None; return record
+
+_exc_text_formatter = logging.Formatter()
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(module)s %(funcName)s %(lineno)d %(message)s %(trace_id)s"
+# Обработчики в запросе только кладут запись в очередь (trace_id фиксируется фильтром до постановки),
+# форматирование в JSON и запись в поток выполняет фоновый поток QueueListener.
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue()
+
 LOGGING_CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
-    "formatters": {
-        "json": {
-            "()": "pythonjsonlogger.jsonlogger.JsonFormatter",
-            "format": "%(asctime)s %(levelname)s %(name)s %(module)s %(funcName)s %(lineno)d %(message)s %(trace_id)s",
-        },
-    },
     "filters": {
         "trace_id_filter": {
             "()": "main.TraceIdFilter", # <-- ИСПРАВЛЕНО: Указан явный путь к классу
@@ -74,8 +117,8 @@ LOGGING_CONFIG = {
     },
     "handlers": {
         "default": {
-            "class": "logging.StreamHandler",
-            "formatter": "json",
+            "class": "main.StructuredQueueHandler",
+            "queue": "ext://main._log_queue",
             "filters": ["trace_id_filter"],
         },
     },
@@ -85,6 +128,8 @@ LOGGING_CONFIG = {
     },
 }
 dictConfig(LOGGING_CONFIG)
+_log_stream_handler = logging.StreamHandler(); _log_stream_handler.setFormatter(OrjsonFormatter(LOG_FORMAT))
+_log_listener = QueueListener(_log_queue, _log_stream_handler); _log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Инициализируем настройки ПОСЛЕ настройки логирования
@@ -93,8 +138,9 @@ settings = Settings()
 # ===============================================================================
 # 2. БАЗА ДАННЫХ
 # ===============================================================================
-engine = create_async_engine(settings.database_url, echo=False)
-AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+if settings.db_use_null_pool: engine = create_async_engine(settings.database_url, echo=False, poolclass=NullPool)
+else: engine = create_async_engine(settings.database_url, echo=False, pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow, pool_timeout=settings.db_pool_timeout, pool_pre_ping=settings.db_pool_pre_ping, pool_recycle=settings.db_pool_recycle)
+AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
 # ===============================================================================
@@ -110,7 +156,7 @@ class Tenant(Base):
     __tablename__ = "tenants"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, comment="Публичный уникальный идентификатор тенанта (PK)")
     name = Column(String, nullable=False, comment="Человекочитаемое название тенанта (Базы Знаний)")
-    created_at = Column(DateTime, default=datetime.datetime.utcnow, comment="Дата и время создания тенанта")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="Дата и время создания тенанта")
 
 class User(Base):
     __tablename__ = "users"
@@ -129,13 +175,28 @@ class KnowledgeEvent(Base):
     tenant_id = Column(UUID(as_uuid=True), ForeignKey("tenants.id"), nullable=False, index=True, comment="Идентификатор тенанта, которому принадлежит событие (FK)")
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=True, comment="Идентификатор пользователя, совершившего действие (FK)")
     operation = Column(String, nullable=False, comment="Тип операции (created, updated, deleted, status_changed)")
-    operation_time = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, comment="Точное время совершения операции")
+    operation_time = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), comment="Точное время совершения операции")
     item_name = Column(String, nullable=False, comment="Название файла или ссылки на момент события")
     item_type = Column(String, nullable=False, comment="Тип элемента (file или link)")
     content = Column(String, nullable=True, comment="Содержимое: S3-ключ для файла или URL для ссылки")
     size = Column(BigInteger, nullable=True, comment="Размер файла в байтах (для ссылок - NULL)")
     status = Column(String, nullable=False, comment="Статус элемента на момент события (new, processing, done, failed)")
-    __table_args__ = (Index('ix_knowledge_events_status_op', "status", "operation"),)
+    __table_args__ = (Index('ix_knowledge_events_status_op', "status", "operation"), Index('ix_events_tenant_item_time', "tenant_id", "item_uuid", text("operation_time DESC")))
+    # operation_time заполняет сервер; eager_defaults возвращает его через RETURNING в том же INSERT
+    __mapper_args__ = {"eager_defaults": True}
+
+class CurrentItem(Base):
+    __tablename__ = "current_items"
+    item_uuid = Column(UUID(as_uuid=True), primary_key=True, comment="Логический идентификатор живого элемента (PK)")
+    tenant_id = Column(UUID(as_uuid=True), ForeignKey("tenants.id"), nullable=False, index=True, comment="Идентификатор тенанта, которому принадлежит элемент (FK)")
+    item_name = Column(String, nullable=False, comment="Текущее название файла или ссылки")
+    item_type = Column(String, nullable=False, comment="Тип элемента (file или link)")
+    content = Column(String, nullable=True, comment="Содержимое: S3-ключ для файла или URL для ссылки")
+    size = Column(BigInteger, nullable=True, comment="Размер файла в байтах (для ссылок - NULL)")
+    status = Column(String, nullable=False, comment="Текущий статус элемента")
+    operation = Column(String, nullable=False, comment="Последняя выполненная операция")
+    operation_time = Column(DateTime(timezone=True), nullable=False, comment="Время последней операции")
+    __table_args__ = (Index('ix_current_items_name_trgm', "item_name", postgresql_using="gin", postgresql_ops={"item_name": "gin_trgm_ops"}),)
 
 # ===============================================================================
 # 4. СХЕМЫ ДАННЫХ API (Pydantic) С КОММЕНТАРИЯМИ
@@ -155,41 +216,125 @@ class ItemResponse(BaseModel):
 class LinkCreate(BaseModel): name: str; url: str
 class LinkUpdate(BaseModel): name: Optional[str] = None; url: Optional[str] = None
 class StatusUpdate(BaseModel): status: StatusType
+class ItemBatchDelete(BaseModel): item_uuids: List[uuid.UUID] = Field(min_length=1, max_length=1000, description="Логические ID удаляемых элементов")
 class FileDownloadResponse(BaseModel): download_url: str
 class ComponentStatus(BaseModel): status: str; details: Optional[str] = None
 class DeepHealthCheckResponse(BaseModel): api: ComponentStatus; database: ComponentStatus; storage: ComponentStatus
+_HEALTHY_BODY = DeepHealthCheckResponse(api=ComponentStatus(status="ok"), database=ComponentStatus(status="ok"), storage=ComponentStatus(status="ok")).model_dump_json().encode()
 
 # ===============================================================================
 # 5. БЕЗОПАСНОСТЬ, S3 и ИНИЦИАЛИЗАЦИЯ ПРИЛОЖЕНИЯ
 # ===============================================================================
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+pwd_context = PasswordHasher()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 DEFAULT_ADMIN_USERNAME = "admin"
 DEFAULT_ADMIN_PASSWORD = "admin123"
+# Кеш успешно проверенных токенов: blake2b(токен) -> (истекает_в, user_id).
+# Неуспешные проверки не кешируются, запись живет не дольше exp самого токена.
+TOKEN_CACHE_TTL_SECONDS = 60
+TOKEN_CACHE_MAX_SIZE = 10_000
+_token_cache: Dict[bytes, Tuple[float, uuid.UUID]] = {}
+# Кеш строк пользователей: user_id -> (истекает_в, username, role, tenant_id, is_active).
+USER_CACHE_TTL_SECONDS = 30
+USER_CACHE_MAX_SIZE = 5000
+_user_cache: Dict[uuid.UUID, Tuple[float, str, str, uuid.UUID, bool]] = {}
+# Кеш успешных входов: keyed-blake2b(логин, пароль) -> (истекает_в, user_id); повторный вход пропускает argon2.
+LOGIN_CACHE_TTL_SECONDS = 30
+LOGIN_CACHE_MAX_SIZE = 1000
+_login_cache: Dict[bytes, Tuple[float, uuid.UUID]] = {}
+_LOGIN_CACHE_KEY = settings.secret_key.encode()[:32]
+# Результат глубокой проверки кешируется, чтобы частые пробы Kubernetes не нагружали БД и S3.
+HEALTH_CACHE_TTL_SECONDS = 5.0
+HEALTH_CHECK_TIMEOUT_SECONDS = 2.0
+_health_cache = {"ts": 0.0, "status_code": None, "body": None}
 s3_session = aioboto3.Session()
+# Крупные файлы загружаются multipart-частями по 16 МБ с ограниченной очередью, мелкие - одним put_object.
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_TRANSFER_CFG = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_MULTIPART_THRESHOLD, max_concurrency=8, max_io_queue=8, use_threads=False)
+
+app = FastAPI(title="Knowledge Base API (Production)", version="3.1.0", default_response_class=ORJSONResponse)
 
-app = FastAPI(title="Knowledge Base API (Production)", version="3.1.0")
+DEFAULT_TENANT_NAME = "Тест"
+
+async def _seed_state(db: AsyncSession):
+    # Один запрос: есть ли администратор и id тенанта по умолчанию (если он уже создан)
+    admin_exists = select(User.id).where(User.username == DEFAULT_ADMIN_USERNAME).exists()
+    tenant_id = select(Tenant.id).where(Tenant.name == DEFAULT_TENANT_NAME).limit(1).scalar_subquery()
+    return (await db.execute(select(admin_exists, tenant_id))).one()
 
 async def seed_initial_data(db: AsyncSession):
     logger.info("Checking for initial data seeding...")
     try:
-        default_tenant_name = "Тест"; result = await db.execute(select(Tenant).where(Tenant.name == default_tenant_name)); tenant = result.scalars().first()
-        if not tenant: logger.warning(f"Default tenant '{default_tenant_name}' not found, creating it."); tenant = Tenant(name=default_tenant_name); db.add(tenant); await db.commit(); await db.refresh(tenant); logger.info(f"Default tenant '{tenant.name}' created with id {tenant.id}")
+        admin_exists, tenant_id = await _seed_state(db)
+        if admin_exists: logger.info("Default admin user already exists."); return
+        # Пишет только один процесс: остальные не получают advisory-лок транзакции и пропускают заполнение
+        if db.get_bind().dialect.name == "postgresql":
+            if not (await db.execute(text("SELECT pg_try_advisory_xact_lock(hashtext('seed_initial_data'))"))).scalar(): logger.info("Initial data seeding is running in another process, skipping."); return
+            admin_exists, tenant_id = await _seed_state(db)
+            if admin_exists: logger.info("Default admin user already exists."); return
+        if tenant_id is None: logger.warning(f"Default tenant '{DEFAULT_TENANT_NAME}' not found, creating it."); tenant = Tenant(name=DEFAULT_TENANT_NAME); db.add(tenant); await db.flush(); tenant_id = tenant.id; logger.info(f"Default tenant '{tenant.name}' created with id {tenant_id}")
         else: logger.info("Default tenant already exists.")
-        result = await db.execute(select(User).where(User.username == DEFAULT_ADMIN_USERNAME)); admin_user = result.scalars().first()
-        if not admin_user: logger.warning(f"Default admin user '{DEFAULT_ADMIN_USERNAME}' not found, creating it."); hashed_password = pwd_context.hash(DEFAULT_ADMIN_PASSWORD); admin_user = User(username=DEFAULT_ADMIN_USERNAME, hashed_password=hashed_password, role=UserRole.ADMIN, tenant_id=tenant.id); db.add(admin_user); await db.commit(); logger.info(f"Default admin user '{admin_user.username}' created.")
-        else: logger.info("Default admin user already exists.")
+        logger.warning(f"Default admin user '{DEFAULT_ADMIN_USERNAME}' not found, creating it."); admin_user = User(username=DEFAULT_ADMIN_USERNAME, hashed_password=pwd_context.hash(DEFAULT_ADMIN_PASSWORD), role=UserRole.ADMIN, tenant_id=tenant_id); db.add(admin_user); await db.commit(); logger.info(f"Default admin user '{admin_user.username}' created.")
     except Exception as e: logger.error(f"An error occurred during initial data seeding: {e}", exc_info=True); await db.rollback(); raise
 
+# create_all не меняет существующие таблицы: колонкам времени из прежних версий (naive UTC, без DEFAULT)
+# переводим тип в timestamptz и ставим DEFAULT now(), на который полагаются INSERT событий и тенантов
+_TIMESTAMP_COLUMNS = (("knowledge_events", "operation_time", True), ("tenants", "created_at", True), ("current_items", "operation_time", False))
+_TIMESTAMPTZ_UPGRADE = """
+DO $$ BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = '{column}' AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamptz USING {column} AT TIME ZONE 'UTC';
+    END IF;
+END $$"""
+
+async def _upgrade_timestamp_columns(conn):
+    for table, column, with_default in _TIMESTAMP_COLUMNS:
+        await conn.execute(text(_TIMESTAMPTZ_UPGRADE.format(table=table, column=column)))
+        if with_default: await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT now()"))
+
+async def initialize_database(target_engine):
+    """Создает расширения, таблицы и начальные данные. Идемпотентна; вызывается из init_db.py."""
+    async with target_engine.begin() as conn:
+        logger.info("Checking and creating tables if they do not exist...")
+        if conn.dialect.name == "postgresql": await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        await conn.run_sync(Base.metadata.create_all)
+        if conn.dialect.name == "postgresql": await _upgrade_timestamp_columns(conn)
+        await backfill_current_items(conn); logger.info("Tables are ready.")
+    async with async_sessionmaker(target_engine, expire_on_commit=False)() as session: await seed_initial_data(session)
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("Application startup...");
-    async with engine.begin() as conn: logger.info("Checking and creating tables if they do not exist..."); await conn.run_sync(Base.metadata.create_all); logger.info("Tables are ready.")
-    async with AsyncSessionLocal() as session: await seed_initial_data(session)
+    if not settings.schema_ready: logger.warning("SCHEMA_READY is not set, initializing database in-process."); await initialize_database(engine)
+    # Один S3-клиент на процесс: пул HTTP-соединений и учетные данные переиспользуются между запросами.
+    app.state.s3_client_ctx = s3_session.client("s3", endpoint_url=settings.s3_endpoint_url, aws_access_key_id=settings.s3_access_key_id, aws_secret_access_key=settings.s3_secret_access_key, region_name=settings.s3_region)
+    app.state.s3 = await app.state.s3_client_ctx.__aenter__()
+    # Подпись presigned URL - локальное вычисление SigV4, синхронному клиенту сеть не нужна.
+    app.state.s3_presigner = botocore.session.get_session().create_client("s3", endpoint_url=settings.s3_endpoint_url, aws_access_key_id=settings.s3_access_key_id, aws_secret_access_key=settings.s3_secret_access_key, region_name=settings.s3_region)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    logger.info("Application shutdown...")
+    await app.state.s3_client_ctx.__aexit__(None, None, None)
+    _log_listener.stop()
+
+class UUIDPool:
+    """Раздает UUID4 из блока случайных байт, полученного одним os.urandom на size запросов; следующий блок готовится в пуле потоков."""
+    def __init__(self, size: int = 4096): self._size = size; self._buffer = os.urandom(16 * size); self._index = 0; self._pending = None
+    def _swap_buffer(self):
+        pending, self._pending = self._pending, None
+        self._buffer = pending.result() if pending is not None and pending.done() and not pending.cancelled() and pending.exception() is None else os.urandom(16 * self._size); self._index = 0
+    def next(self) -> str:
+        if self._index >= self._size: self._swap_buffer()
+        start = self._index * 16; self._index += 1
+        if self._index == self._size // 2 and self._pending is None: self._pending = asyncio.get_running_loop().run_in_executor(None, os.urandom, 16 * self._size)
+        return str(uuid.UUID(bytes=self._buffer[start:start + 16], version=4))  # version=4 выставляет биты версии/варианта как uuid4()
+
+_trace_id_pool = UUIDPool()
 
 @app.middleware("http")
 async def add_trace_id_middleware(request: Request, call_next):
-    trace_id = request.headers.get("X-Request-ID", str(uuid.uuid4())); token = trace_id_var.set(trace_id)
+    trace_id = request.headers.get("X-Request-ID") or _trace_id_pool.next(); token = trace_id_var.set(trace_id)
     logger.info("Request started", extra={"path": request.url.path, "method": request.method})
     response = await call_next(request); response.headers["X-Request-ID"] = trace_id; trace_id_var.reset(token)
     return response
@@ -197,28 +342,98 @@ async def add_trace_id_middleware(request: Request, call_next):
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session: yield session
 
-async def get_s3_client():
-    async with s3_session.client("s3", endpoint_url=settings.s3_endpoint_url, aws_access_key_id=settings.s3_access_key_id, aws_secret_access_key=settings.s3_secret_access_key, region_name=settings.s3_region) as s3:
-        yield s3
+async def get_s3_client(request: Request):
+    return request.app.state.s3
 
-def verify_password(plain_password, hashed_password): return pwd_context.verify(plain_password, hashed_password)
+def verify_password(plain_password, hashed_password):
+    if not hashed_password: return False
+    try: return pwd_context.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError): return False
 def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta] = None):
     to_encode = data.copy(); expire = datetime.datetime.utcnow() + (expires_delta or datetime.timedelta(minutes=settings.access_token_expire_minutes)); to_encode.update({"exp": expire})
     return jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
 
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def _cache_put(cache: dict, max_size: int, key, entry: tuple):
+    if len(cache) >= max_size:
+        now = time.time()
+        for stale_key in [k for k, value in cache.items() if value[0] <= now]: del cache[stale_key]
+        if len(cache) >= max_size: cache.clear()
+    cache[key] = entry
+
+def _cache_get(cache: dict, key) -> Optional[tuple]:
+    entry = cache.get(key)
+    if entry is None: return None
+    if time.time() >= entry[0]: cache.pop(key, None); return None
+    return entry
+
+def invalidate_user(user_id: uuid.UUID):
+    """Сбрасывает закешированные токены, входы и строку пользователя (вызывать при любом изменении пользователя)."""
+    _user_cache.pop(user_id, None)
+    for key in [k for k, entry in _login_cache.items() if entry[1] == user_id]: del _login_cache[key]
+    for key in [k for k, entry in _token_cache.items() if entry[1] == user_id]: del _token_cache[key]
+
+async def _load_user(db: AsyncSession, user_id: uuid.UUID) -> Optional[User]:
+    cached = _cache_get(_user_cache, user_id)
+    if cached is not None:
+        _, username, role, tenant_id, is_active = cached
+        return User(id=user_id, username=username, role=role, tenant_id=tenant_id, is_active=is_active)
+    user = await db.get(User, user_id)
+    if user is not None: _cache_put(_user_cache, USER_CACHE_MAX_SIZE, user_id, (time.time() + USER_CACHE_TTL_SECONDS, user.username, user.role, user.tenant_id, user.is_active))
+    return user
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
-    try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]); user_id: str = payload.get("user_id")
-        if user_id is None: raise credentials_exception
-    except JWTError: raise credentials_exception
-    user = await db.get(User, uuid.UUID(user_id))
+    key = _token_key(token); cached = _cache_get(_token_cache, key); payload = None
+    if cached is not None: user_id = cached[1]
+    else:
+        try:
+            payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]); raw_user_id: str = payload.get("user_id")
+            if raw_user_id is None: raise credentials_exception
+            user_id = uuid.UUID(raw_user_id)
+        except (JWTError, ValueError): raise credentials_exception
+    user = await _load_user(db, user_id)
     if user is None or not user.is_active: raise credentials_exception
+    if payload is not None:
+        expires_at = time.time() + TOKEN_CACHE_TTL_SECONDS
+        if payload.get("exp") is not None: expires_at = min(expires_at, float(payload["exp"]))
+        _cache_put(_token_cache, TOKEN_CACHE_MAX_SIZE, key, (expires_at, user_id))
     return user
 
-async def get_latest_event_for_item(db: AsyncSession, item_uuid: uuid.UUID, tenant_id: uuid.UUID) -> Optional[KnowledgeEvent]:
-    result = await db.execute(select(KnowledgeEvent).where(KnowledgeEvent.item_uuid == item_uuid, KnowledgeEvent.tenant_id == tenant_id).order_by(KnowledgeEvent.operation_time.desc()).limit(1))
-    return result.scalars().first()
+def _latest_events_subquery(dialect_name: str):
+    # На PostgreSQL последнее событие по каждому элементу берется через DISTINCT ON по индексу
+    # (tenant_id, item_uuid, operation_time DESC); оконная функция остается для остальных диалектов (SQLite в тестах).
+    if dialect_name == "postgresql":
+        return select(KnowledgeEvent).distinct(KnowledgeEvent.item_uuid).order_by(KnowledgeEvent.item_uuid, KnowledgeEvent.operation_time.desc()).subquery()
+    ranked = select(KnowledgeEvent, func.row_number().over(partition_by=KnowledgeEvent.item_uuid, order_by=KnowledgeEvent.operation_time.desc()).label("rn")).subquery()
+    return select(*[ranked.c[column.name] for column in KnowledgeEvent.__table__.columns]).where(ranked.c.rn == 1).subquery()
+
+async def backfill_current_items(conn):
+    """Заполняет пустую current_items из истории событий (однократно, при первом запуске после миграции)."""
+    if (await conn.execute(select(func.count()).select_from(CurrentItem))).scalar(): return
+    latest = _latest_events_subquery(conn.dialect.name); columns = [column.name for column in CurrentItem.__table__.columns]
+    await conn.execute(insert(CurrentItem).from_select(columns, select(*[latest.c[name] for name in columns]).where(latest.c.operation != OperationType.DELETED)))
+
+# Только колонки, нужные ItemResponse: списки не тянут content и не наполняют identity map
+_ITEM_RESPONSE_COLUMNS = (CurrentItem.item_uuid, CurrentItem.item_name, CurrentItem.item_type, CurrentItem.size, CurrentItem.status, CurrentItem.operation, CurrentItem.operation_time)
+_CURRENT_ITEM_FIELDS = ("tenant_id", "item_name", "item_type", "content", "size", "status", "operation", "operation_time")
+
+async def sync_current_item(db: AsyncSession, event: KnowledgeEvent):
+    """Обновляет строку current_items в той же транзакции, что и новое событие."""
+    if event.operation == OperationType.DELETED: await db.execute(delete(CurrentItem).where(CurrentItem.item_uuid == event.item_uuid)); return
+    if event.operation_time is None: await db.flush()
+    values = {name: getattr(event, name) for name in _CURRENT_ITEM_FIELDS}
+    upsert = (pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert)(CurrentItem).values(item_uuid=event.item_uuid, **values)
+    await db.execute(upsert.on_conflict_do_update(index_elements=[CurrentItem.item_uuid], set_=values))
+
+async def get_latest_events(db: AsyncSession, item_uuids: List[uuid.UUID], tenant_id: uuid.UUID) -> Dict[uuid.UUID, CurrentItem]:
+    result = await db.execute(select(CurrentItem).where(CurrentItem.tenant_id == tenant_id, CurrentItem.item_uuid.in_(item_uuids)))
+    return {item.item_uuid: item for item in result.scalars()}
+
+async def get_latest_event_for_item(db: AsyncSession, item_uuid: uuid.UUID, tenant_id: uuid.UUID) -> Optional[CurrentItem]:
+    return (await get_latest_events(db, [item_uuid], tenant_id)).get(item_uuid)
 
 # ===============================================================================
 # 6. API ЭНДПОИНТЫ
@@ -226,8 +441,12 @@ async def get_latest_event_for_item(db: AsyncSession, item_uuid: uuid.UUID, tena
 
 @app.post("/token", tags=["Auth"])
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User).where(User.username == form_data.username)); user = result.scalars().first()
-    if not user or not user.is_active or not verify_password(form_data.password, user.hashed_password): raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password", headers={"WWW-Authenticate": "Bearer"})
+    login_key = hashlib.blake2b(f"{form_data.username}\x00{form_data.password}".encode(), key=_LOGIN_CACHE_KEY, digest_size=32).digest()
+    cached = _cache_get(_login_cache, login_key)
+    if cached is not None: user = await _load_user(db, cached[1]); verified = user is not None and user.username == form_data.username
+    else: result = await db.execute(select(User).where(User.username == form_data.username)); user = result.scalars().first(); verified = user is not None and verify_password(form_data.password, user.hashed_password)
+    if not verified or not user.is_active: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password", headers={"WWW-Authenticate": "Bearer"})
+    if cached is None: _cache_put(_login_cache, LOGIN_CACHE_MAX_SIZE, login_key, (time.time() + LOGIN_CACHE_TTL_SECONDS, user.id))
     token_data = {"sub": user.username, "user_id": str(user.id), "tenant_id": str(user.tenant_id)}
     access_token = create_access_token(data=token_data); return {"access_token": access_token, "token_type": "bearer"}
 
@@ -238,27 +457,25 @@ async def read_users_me(current_user: Annotated[User, Depends(get_current_user)]
 @app.post("/files", response_model=ItemResponse, status_code=201, tags=["Items"])
 async def add_file(file: UploadFile, name: Optional[str] = Form(None), db: AsyncSession = Depends(get_db), s3_client=Depends(get_s3_client), current_user: User = Depends(get_current_user)):
     file_name = name or file.filename; item_uuid = uuid.uuid4(); s3_object_key = f"{current_user.tenant_id}/{item_uuid}/{file_name}"
-    try: await s3_client.upload_fileobj(file.file, settings.s3_bucket_name, s3_object_key)
+    try:
+        if file.size is not None and file.size < S3_MULTIPART_THRESHOLD: await s3_client.put_object(Bucket=settings.s3_bucket_name, Key=s3_object_key, Body=await file.read())
+        else: await s3_client.upload_fileobj(file.file, settings.s3_bucket_name, s3_object_key, Config=S3_TRANSFER_CFG)
     except ClientError as e: logger.error("Failed to upload to S3", exc_info=True); raise HTTPException(status_code=500, detail=f"S3 upload failed: {e}")
     new_event = KnowledgeEvent(item_uuid=item_uuid, tenant_id=current_user.tenant_id, user_id=current_user.id, operation=OperationType.CREATED, item_name=file_name, item_type=ItemType.FILE, content=s3_object_key, size=file.size, status=StatusType.NEW)
-    db.add(new_event); await db.commit(); await db.refresh(new_event); return new_event
+    db.add(new_event); await sync_current_item(db, new_event); await db.commit(); return new_event
 
 @app.post("/links", response_model=ItemResponse, status_code=201, tags=["Items"])
 async def add_link(link: LinkCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     new_event = KnowledgeEvent(item_uuid=uuid.uuid4(), tenant_id=current_user.tenant_id, user_id=current_user.id, operation=OperationType.CREATED, item_name=link.name, item_type=ItemType.LINK, content=link.url, status=StatusType.NEW)
-    db.add(new_event); await db.commit(); await db.refresh(new_event); return new_event
+    db.add(new_event); await sync_current_item(db, new_event); await db.commit(); return new_event
 
 @app.get("/items", response_model=List[ItemResponse], tags=["Items"])
 async def get_current_state_of_all_items(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    subquery = select(KnowledgeEvent, func.row_number().over(partition_by=KnowledgeEvent.item_uuid, order_by=KnowledgeEvent.operation_time.desc()).label("rn")).where(KnowledgeEvent.tenant_id == current_user.tenant_id).subquery()
-    query = select(subquery).where(subquery.c.rn == 1, subquery.c.operation != OperationType.DELETED)
-    result = await db.execute(query); return result.all()
+    result = await db.execute(select(*_ITEM_RESPONSE_COLUMNS).where(CurrentItem.tenant_id == current_user.tenant_id)); return result.all()
 
 @app.get("/items/search", response_model=List[ItemResponse], tags=["Items"])
 async def search_items(q: str, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    subquery = select(KnowledgeEvent, func.row_number().over(partition_by=KnowledgeEvent.item_uuid, order_by=KnowledgeEvent.operation_time.desc()).label("rn")).where(KnowledgeEvent.tenant_id == current_user.tenant_id).subquery()
-    query = select(subquery).where(subquery.c.rn == 1, subquery.c.operation != OperationType.DELETED, subquery.c.item_name.ilike(f"%{q}%"))
-    result = await db.execute(query); return result.all()
+    result = await db.execute(select(*_ITEM_RESPONSE_COLUMNS).where(CurrentItem.tenant_id == current_user.tenant_id, CurrentItem.item_name.ilike(f"%{q}%"))); return result.all()
 
 @app.get("/items/{item_uuid}", response_model=ItemResponse, tags=["Items"])
 async def get_item(item_uuid: uuid.UUID, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
@@ -268,10 +485,10 @@ async def get_item(item_uuid: uuid.UUID, db: AsyncSession = Depends(get_db), cur
     return latest_event
 
 @app.get("/files/{item_uuid}/download", response_model=FileDownloadResponse, tags=["Items"])
-async def get_file_download_url(item_uuid: uuid.UUID, db: AsyncSession = Depends(get_db), s3_client=Depends(get_s3_client), current_user: User = Depends(get_current_user)):
+async def get_file_download_url(item_uuid: uuid.UUID, request: Request, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
     latest_event = await get_latest_event_for_item(db, item_uuid, current_user.tenant_id)
     if not latest_event or latest_event.operation == OperationType.DELETED or latest_event.item_type != ItemType.FILE: raise HTTPException(status_code=404, detail="File not found")
-    try: url = await s3_client.generate_presigned_url('get_object', Params={'Bucket': settings.s3_bucket_name, 'Key': latest_event.content}, ExpiresIn=3600); return {"download_url": url}
+    try: url = request.app.state.s3_presigner.generate_presigned_url('get_object', Params={'Bucket': settings.s3_bucket_name, 'Key': latest_event.content}, ExpiresIn=3600); return {"download_url": url}
     except ClientError as e: logger.error("Failed to generate presigned S3 URL", exc_info=True); raise HTTPException(status_code=500, detail="Could not generate download link.")
 
 @app.delete("/items/{item_uuid}", status_code=status.HTTP_204_NO_CONTENT, tags=["Items"])
@@ -282,7 +499,18 @@ async def delete_item(item_uuid: uuid.UUID, db: AsyncSession = Depends(get_db),
         try: await s3_client.delete_object(Bucket=settings.s3_bucket_name, Key=latest_event.content)
         except ClientError: logger.error("Failed to delete object from S3, but proceeding with DB event", exc_info=True)
     delete_event = KnowledgeEvent(item_uuid=item_uuid, tenant_id=current_user.tenant_id, user_id=current_user.id, operation=OperationType.DELETED, item_name=latest_event.item_name, item_type=latest_event.item_type, status=StatusType.NEW)
-    db.add(delete_event); await db.commit(); return Response(status_code=status.HTTP_204_NO_CONTENT)
+    db.add(delete_event); await sync_current_item(db, delete_event); await db.commit(); return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@app.post("/items:batch_delete", status_code=status.HTTP_204_NO_CONTENT, tags=["Items"])
+async def batch_delete_items(batch: ItemBatchDelete, db: AsyncSession = Depends(get_db), s3_client=Depends(get_s3_client), current_user: User = Depends(get_current_user)):
+    items = await get_latest_events(db, batch.item_uuids, current_user.tenant_id)
+    if not items: return Response(status_code=status.HTTP_204_NO_CONTENT)
+    file_keys = [{"Key": item.content} for item in items.values() if item.item_type == ItemType.FILE and item.content]
+    if file_keys:
+        try: await s3_client.delete_objects(Bucket=settings.s3_bucket_name, Delete={"Objects": file_keys, "Quiet": True})
+        except ClientError: logger.error("Failed to delete objects from S3, but proceeding with DB events", exc_info=True)
+    db.add_all([KnowledgeEvent(item_uuid=item.item_uuid, tenant_id=current_user.tenant_id, user_id=current_user.id, operation=OperationType.DELETED, item_name=item.item_name, item_type=item.item_type, status=StatusType.NEW) for item in items.values()])
+    await db.execute(delete(CurrentItem).where(CurrentItem.item_uuid.in_(list(items)))); await db.commit(); return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @app.patch("/items/{item_uuid}/status", response_model=ItemResponse, tags=["Items"])
 async def update_item_status(item_uuid: uuid.UUID, status_update: StatusUpdate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
@@ -290,13 +518,17 @@ async def update_item_status(item_uuid: uuid.UUID, status_update: StatusUpdate,
     if not latest_event or latest_event.operation == OperationType.DELETED: raise HTTPException(status_code=404, detail="Item not found")
     if latest_event.status == status_update.status: return latest_event
     status_change_event = KnowledgeEvent(item_uuid=item_uuid, tenant_id=current_user.tenant_id, user_id=current_user.id, operation=OperationType.STATUS_CHANGED, item_name=latest_event.item_name, item_type=latest_event.item_type, content=latest_event.content, size=latest_event.size, status=status_update.status)
-    db.add(status_change_event); await db.commit(); await db.refresh(status_change_event); return status_change_event
+    db.add(status_change_event); await sync_current_item(db, status_change_event); await db.commit(); return status_change_event
+
+async def _probe(make_call) -> dict:
+    try: await asyncio.wait_for(make_call(), timeout=HEALTH_CHECK_TIMEOUT_SECONDS); return {"status": "ok"}
+    except Exception as e: return {"status": "down", "details": str(e) or type(e).__name__}
 
 @app.get("/health", response_model=DeepHealthCheckResponse, tags=["Monitoring"])
 async def health_check(db: AsyncSession = Depends(get_db), s3_client=Depends(get_s3_client)):
-    health = { "api": {"status": "ok"}, "database": {"status": "ok"}, "storage": {"status": "ok"} }; http_status = status.HTTP_200_OK
-    try: await db.execute(text("SELECT 1"))
-    except Exception as e: health["database"] = {"status": "down", "details": str(e)}; http_status = status.HTTP_503_SERVICE_UNAVAILABLE
-    try: await s3_client.head_bucket(Bucket=settings.s3_bucket_name)
-    except Exception as e: health["storage"] = {"status": "down", "details": str(e)}; http_status = status.HTTP_503_SERVICE_UNAVAILABLE
-    return Response(content=DeepHealthCheckResponse(**health).model_dump_json(), status_code=http_status, media_type="application/json")
\ No newline at end of file
+    if _health_cache["body"] is not None and time.monotonic() - _health_cache["ts"] < HEALTH_CACHE_TTL_SECONDS: return Response(content=_health_cache["body"], status_code=_health_cache["status_code"], media_type="application/json")
+    database, storage = await asyncio.gather(_probe(lambda: db.execute(text("SELECT 1"))), _probe(lambda: s3_client.head_bucket(Bucket=settings.s3_bucket_name)))
+    if database["status"] == "ok" and storage["status"] == "ok": http_status = status.HTTP_200_OK; body = _HEALTHY_BODY
+    else: http_status = status.HTTP_503_SERVICE_UNAVAILABLE; body = DeepHealthCheckResponse(api={"status": "ok"}, database=database, storage=storage).model_dump_json()
+    _health_cache.update(ts=time.monotonic(), status_code=http_status, body=body)
+    return Response(content=body, status_code=http_status, media_type="application/json")
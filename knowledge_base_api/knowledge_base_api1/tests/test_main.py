@@ -1,54 +1,85 @@
+import asyncio
+
 import pytest
 import pytest_asyncio
 from httpx import AsyncClient
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
 
-from main import app, Base, get_db, User, Tenant, UserRole, pwd_context, get_s3_client
+from main import app, Base, get_db, User, Tenant, UserRole, get_s3_client
 
 TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-engine = create_async_engine(TEST_DATABASE_URL)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+# Одна in-memory база на всю сессию тестов
+engine = create_async_engine(TEST_DATABASE_URL, poolclass=StaticPool)
 
-async def override_get_db():
-    async with TestingSessionLocal() as session:
-        yield session
+# pysqlite/aiosqlite сами управляют транзакциями и ломают SAVEPOINT - отдаем BEGIN под контроль SQLAlchemy
+@event.listens_for(engine.sync_engine, "connect")
+def _disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
 
-app.dependency_overrides[get_db] = override_get_db
+@event.listens_for(engine.sync_engine, "begin")
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
 
 TEST_USERNAME = "testadmin"
 TEST_PASSWORD = "testpassword"
+# Заранее посчитанный PasswordHasher().hash(TEST_PASSWORD) с параметрами argon2-cffi по умолчанию
+TEST_HASHED_PASSWORD = "$argon2id$v=19$m=65536,t=3,p=4$/M6mNseXjX/LoxlmcTyXKg$pBplyBZXTrdgJJzhRWUMDwpW1eEkudD9pS6lOJj5c8w"
 
-@pytest_asyncio.fixture()
-async def client() -> tuple[AsyncClient, str]:
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest_asyncio.fixture(scope="session")
+async def seeded_db():
+    # Схема и тестовый тенант/администратор создаются один раз на сессию
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
 
-    async with TestingSessionLocal() as session:
+    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
         test_tenant = Tenant(name="Test Tenant")
         session.add(test_tenant)
-        await session.commit()
-        await session.refresh(test_tenant)
-        hashed_password = pwd_context.hash(TEST_PASSWORD)
+        await session.flush()
         test_user = User(
             username=TEST_USERNAME,
-            hashed_password=hashed_password,
+            hashed_password=TEST_HASHED_PASSWORD,
             role=UserRole.ADMIN,
             tenant_id=test_tenant.id
         )
         session.add(test_user)
         await session.commit()
 
-    async with AsyncClient(app=app, base_url="http://test") as ac:
-        response = await ac.post("/token", data={"username": TEST_USERNAME, "password": TEST_PASSWORD})
-        assert response.status_code == 200
-        token = response.json()["access_token"]
-        yield ac, token
+    yield
 
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+
+@pytest_asyncio.fixture()
+async def client(seeded_db) -> tuple[AsyncClient, str]:
+    # Каждый тест работает во внешней транзакции; commit() в эндпоинтах фиксирует только SAVEPOINT,
+    # а в конце теста все изменения откатываются без drop_all/create_all
+    async with engine.connect() as conn:
+        transaction = await conn.begin()
+        TestingSessionLocal = async_sessionmaker(bind=conn, expire_on_commit=False, autoflush=False, join_transaction_mode="create_savepoint")
+
+        async def override_get_db():
+            async with TestingSessionLocal() as session:
+                yield session
+
+        app.dependency_overrides[get_db] = override_get_db
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post("/token", data={"username": TEST_USERNAME, "password": TEST_PASSWORD})
+            assert response.status_code == 200
+            token = response.json()["access_token"]
+            yield ac, token
+
+        del app.dependency_overrides[get_db]
+        await transaction.rollback()
 
 @pytest.mark.asyncio
 async def test_health_check(client: tuple[AsyncClient, str]):
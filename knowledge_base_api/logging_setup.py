@@ -6,8 +6,11 @@
 2.  Фильтр `TraceIdFilter` для добавления trace_id в каждую запись лога.
 3.  Словарь `LOGGING_CONFIG` с полной конфигурацией для `logging.dictConfig`.
 4.  Функцию `setup_logging` для применения этой конфигурации.
+5.  Пул `UUIDPool` и функцию `new_trace_id` для генерации ID запросов без системного вызова на каждый запрос.
 """
+import asyncio
 import logging
+import os
 import uuid
 from contextvars import ContextVar
 from logging.config import dictConfig
@@ -67,4 +70,54 @@ LOGGING_CONFIG = {
 # 3. Функция-инициализатор.
 def setup_logging():
     """Применяет конфигурацию логирования из словаря LOGGING_CONFIG."""
-    dictConfig(LOGGING_CONFIG)
\ No newline at end of file
+    dictConfig(LOGGING_CONFIG)
+
+# 4. Генерация trace_id.
+class UUIDPool:
+    """
+    Раздает UUID4 из заранее полученного блока случайных байт.
+
+    `uuid.uuid4()` делает системный вызов `os.urandom(16)` на каждый запрос; пул
+    получает байты сразу на `size` идентификаторов, а следующий блок готовит в
+    пуле потоков, когда израсходована половина текущего. Используется только из
+    потока event loop, поэтому индекс не требует блокировок.
+    """
+    def __init__(self, size: int = 4096):
+        self._size = size
+        self._buffer = os.urandom(16 * size)
+        self._index = 0
+        self._pending: Optional[asyncio.Future] = None
+
+    def _schedule_refill(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._pending = loop.run_in_executor(None, os.urandom, 16 * self._size)
+
+    def _swap_buffer(self):
+        pending, self._pending = self._pending, None
+        if pending is not None and pending.done() and not pending.cancelled() and pending.exception() is None:
+            self._buffer = pending.result()
+        else:
+            # Фоновое заполнение не успело - берем байты синхронно, как uuid4()
+            self._buffer = os.urandom(16 * self._size)
+        self._index = 0
+
+    def next(self) -> str:
+        if self._index >= self._size:
+            self._swap_buffer()
+        start = self._index * 16
+        self._index += 1
+        if self._index == self._size // 2 and self._pending is None:
+            self._schedule_refill()
+        # version=4 выставляет биты версии и варианта так же, как uuid.uuid4()
+        return str(uuid.UUID(bytes=self._buffer[start:start + 16], version=4))
+
+
+_trace_id_pool = UUIDPool()
+
+
+def new_trace_id() -> str:
+    """Возвращает новый trace_id в формате UUID4."""
+    return _trace_id_pool.next()
@@ -1,38 +1,78 @@
 import asyncio
 import logging
-import uuid
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import Optional, Tuple
 
 from fastapi import Depends, FastAPI, Request
 from fastapi.responses import JSONResponse, Response
-from starlette.middleware.base import BaseHTTPMiddleware
 from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 import core
 from core import (
     AsyncSessionLocal,
     engine,
     get_current_user,
-    get_db,
+    get_read_db,
     get_s3_client,
     settings,
     validate_oidc_token,
 )
-from logging_setup import setup_logging, trace_id_var
+from logging_setup import new_trace_id, setup_logging, trace_id_var
 from models import Base, DeepHealthCheckResponse, StatusResponse, Tenant, User, UserRole
 from routers import auth, items, telegram
 from routers import admin as admin_router
+import services
 from services import S3UploadError
 
 setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Knowledge Base API (Production)", version="4.1.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Application startup...")
+    await ensure_schema()
+    chunk_stats_task = asyncio.create_task(
+        services.refresh_tenant_chunk_stats_periodically(settings.tenant_chunk_stats_refresh_seconds)
+    )
+
+    async with AsyncSessionLocal() as session:
+        await seed_initial_data(session)
+
+    # Первый запрос с OIDC-токеном не должен ждать загрузки JWKS
+    if settings.oidc_jwks_url:
+        try:
+            await core.warmup_jwks()
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("JWKS warmup failed, keys will be fetched on first request: %s", exc)
+
+    yield
+
+    chunk_stats_task.cancel()
+    # Дожидаемся снятия advisory-лока до закрытия пула соединений
+    with suppress(asyncio.CancelledError):
+        await chunk_stats_task
+    await core.close_http_client()
+    await engine.dispose()
+    await core.read_engine.dispose()
+
+
+app = FastAPI(title="Knowledge Base API (Production)", version="4.1.0", lifespan=lifespan)
+
+
+# Тела постоянных ответов сериализуются один раз при импорте, а не на каждый запрос
+_ROOT_BODY = b'{"message":"Hello, World!"}'
+_PING_BODY = b'{"status":"ok"}'
 
 
 @app.get("/")
 async def root():
-    return {"message": "Hello, World!"}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 
 @app.exception_handler(S3UploadError)
@@ -43,127 +83,226 @@ async def s3_upload_exception_handler(request: Request, exc: S3UploadError):
     )
 
 
-class OIDCMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.lower().startswith("bearer "):
-            token = auth_header.split(" ", 1)[1]
-            try:
-                claims = await validate_oidc_token(token)
-                request.state.oidc_claims = claims
-                request.state.org_id = claims.get("org_id")
-            except Exception as exc:  # noqa: BLE001
-                logger.warning("OIDC token validation failed: %s", exc)
-        return await call_next(request)
+# Middleware написаны на чистом ASGI: BaseHTTPMiddleware и @app.middleware("http")
+# создают на каждый запрос отдельную task group и потоковый мост для ответа.
+_TRACE_ID_HEADER = b"x-request-id"
+
+
+def _get_raw_header(scope, name: bytes) -> Optional[bytes]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return None
+
+
+def _get_header(scope, name: bytes) -> Optional[str]:
+    value = _get_raw_header(scope, name)
+    return value.decode("latin-1") if value is not None else None
+
+
+class OIDCMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            auth_header = _get_header(scope, b"authorization")
+            if auth_header and auth_header.lower().startswith("bearer "):
+                token = auth_header.split(" ", 1)[1]
+                try:
+                    claims = await validate_oidc_token(token)
+                    # scope["state"] - хранилище, которое Starlette отдает как request.state
+                    state = scope.setdefault("state", {})
+                    state["oidc_claims"] = claims
+                    state["org_id"] = claims.get("org_id")
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("OIDC token validation failed: %s", exc)
+        await self.app(scope, receive, send)
+
+
+class TraceIDMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Входящий заголовок возвращается клиенту теми же байтами, без повторного кодирования
+        trace_id_bytes = _get_raw_header(scope, _TRACE_ID_HEADER)
+        if trace_id_bytes:
+            trace_id = trace_id_bytes.decode("latin-1")
+        else:
+            trace_id = new_trace_id()
+            trace_id_bytes = trace_id.encode("ascii")
+        trace_header = (_TRACE_ID_HEADER, trace_id_bytes)
+
+        async def send_with_trace_id(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), trace_header]
+            await send(message)
+
+        token = trace_id_var.set(trace_id)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            trace_id_var.reset(token)
 
 
 app.add_middleware(OIDCMiddleware)
+# Добавлен последним - внешний слой, trace_id доступен и в OIDCMiddleware
+app.add_middleware(TraceIDMiddleware)
 app.include_router(auth.router)
 app.include_router(items.router)
 app.include_router(admin_router.router)
 app.include_router(telegram.router)
 
 
+# Версия схемы хранится одной строкой; при совпадении с Base.metadata.info["version"]
+# старт не выполняет DDL вообще (create_all — десятки запросов на каждый под)
+SCHEMA_VERSION_DDL = text(
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1), version INTEGER NOT NULL)"
+)
+SELECT_SCHEMA_VERSION = text("SELECT version FROM schema_version")
+UPSERT_SCHEMA_VERSION = text(
+    "INSERT INTO schema_version (id, version) VALUES (1, :version) "
+    "ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version"
+)
+# create_all не добавляет ограничения в существующие таблицы, а ON CONFLICT (name) при заполнении
+# начальных данных требует уникальности tenants.name (для развертываний без миграции 004)
+TENANTS_NAME_UNIQUE_DDL = text(
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'tenants_name_key' AND conrelid = 'tenants'::regclass) THEN
+            ALTER TABLE tenants ADD CONSTRAINT tenants_name_key UNIQUE (name);
+        END IF;
+    END $$
+    """
+)
+SCHEMA_LOCK = text("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+
+
+async def ensure_schema():
+    expected_version = Base.metadata.info.get("version")
+    if expected_version is not None:
+        try:
+            async with engine.connect() as conn:
+                if await conn.scalar(SELECT_SCHEMA_VERSION) == expected_version:
+                    logger.info("Database schema is at version %s, skipping create_all.", expected_version)
+                    return
+        except DBAPIError:
+            # Таблицы schema_version еще нет — первый запуск
+            pass
+
+    async with engine.begin() as conn:
+        # Поды, стартующие одновременно, ждут здесь, пока схему создаст первый, и затем видят актуальную версию
+        await conn.execute(SCHEMA_LOCK)
+        await conn.execute(SCHEMA_VERSION_DDL)
+        if expected_version is not None and await conn.scalar(SELECT_SCHEMA_VERSION) == expected_version:
+            return
+        logger.info("Creating database schema (version %s)...", expected_version)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(TENANTS_NAME_UNIQUE_DDL)
+        await services.ensure_tenant_chunk_stats(conn)
+        if expected_version is not None:
+            await conn.execute(UPSERT_SCHEMA_VERSION, {"version": expected_version})
+
+
 async def seed_initial_data(db: AsyncSession):
     logger.info("Checking for initial data seeding...")
     try:
-        tenant_name = settings.initial_tenant_name
-        result = await db.execute(select(Tenant).where(Tenant.name == tenant_name))
-        tenant = result.scalars().first()
-        if not tenant:
-            tenant = Tenant(name=tenant_name)
-            db.add(tenant)
-            await db.commit()
-            await db.refresh(tenant)
-
-        admin_username = settings.initial_admin_username
-        result = await db.execute(select(User).where(User.username == admin_username))
-        admin_user = result.scalars().first()
-        if not admin_user:
-            hashed_password = core.pwd_context.hash(settings.initial_admin_password)
-            admin_user = User(
-                username=admin_username,
-                hashed_password=hashed_password,
-                role=UserRole.ADMIN,
-                tenant_id=tenant.id,
-                idp_subject=admin_username,
+        # Одна транзакция; ON CONFLICT вместо SELECT-перед-INSERT, без промежуточных commit/refresh
+        async with db.begin():
+            tenant_name = settings.initial_tenant_name
+            tenant_id = await db.scalar(
+                pg_insert(Tenant)
+                .values(name=tenant_name)
+                .on_conflict_do_nothing(index_elements=["name"])
+                .returning(Tenant.id)
             )
-            db.add(admin_user)
-            await db.commit()
-            await db.refresh(admin_user)
+            if tenant_id is None:
+                tenant_id = await db.scalar(select(Tenant.id).where(Tenant.name == tenant_name))
+
+            admin_username = settings.initial_admin_username
+            # Проверка остается, чтобы не считать argon2-хэш при каждом старте
+            if await db.scalar(select(User.id).where(User.username == admin_username)) is None:
+                # argon2 занимает десятки мс CPU — считаем в потоке, чтобы не блокировать event loop
+                hashed_password = await asyncio.to_thread(core.pwd_context.hash, settings.initial_admin_password)
+                await db.execute(
+                    pg_insert(User)
+                    .values(
+                        username=admin_username,
+                        hashed_password=hashed_password,
+                        role=UserRole.ADMIN,
+                        tenant_id=tenant_id,
+                        idp_subject=admin_username,
+                    )
+                    .on_conflict_do_nothing(index_elements=["username"])
+                )
     except Exception as e:  # noqa: BLE001
         logger.error("An error occurred during initial data seeding: %s", e, exc_info=True)
         await db.rollback()
         raise
 
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Application startup...")
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+@app.get("/ping", tags=["Monitoring"], summary="Проверка живости процесса без обращения к БД и S3")
+async def ping():
+    return Response(content=_PING_BODY, media_type="application/json")
 
-    async with AsyncSessionLocal() as session:
-        await seed_initial_data(session)
+
+# Результат глубокой проверки разделяют одновременные пробы: (time.monotonic(), HTTP-статус, тело ответа)
+_HEALTH_CACHE_TTL_SECONDS = 2.0
+_HEALTH_CHECK_TIMEOUT_SECONDS = 1.0
+_health_cache: Optional[Tuple[float, int, bytes]] = None
+_health_lock = asyncio.Lock()
 
 
-@app.middleware("http")
-async def add_trace_id_middleware(request: Request, call_next):
-    trace_id = request.headers.get("X-Request-ID", str(uuid.uuid4()))
-    token = trace_id_var.set(trace_id)
-    response = await call_next(request)
-    response.headers["X-Request-ID"] = trace_id
-    trace_id_var.reset(token)
-    return response
+def _cached_health() -> Optional[Response]:
+    if _health_cache is None or time.monotonic() - _health_cache[0] >= _HEALTH_CACHE_TTL_SECONDS:
+        return None
+    return Response(content=_health_cache[2], status_code=_health_cache[1], media_type="application/json")
+
+
+async def _db_check(db: AsyncSession):
+    return await asyncio.wait_for(db.execute(text("SELECT 1")), _HEALTH_CHECK_TIMEOUT_SECONDS)
+
+
+async def _s3_check(s3_client):
+    return await asyncio.wait_for(s3_client.head_bucket(Bucket=settings.s3_bucket_name), _HEALTH_CHECK_TIMEOUT_SECONDS)
 
 
 @app.get("/health", response_model=DeepHealthCheckResponse, tags=["Monitoring"], summary="Проверка состояния сервиса")
-async def health_check(db: AsyncSession = Depends(get_db), s3_client=Depends(get_s3_client)):
-    health = {"api": {"status": "ok"}, "database": {"status": "ok"}, "storage": {"status": "ok"}}
-    http_status = 200
-    try:
-        await db.execute(text("SELECT 1"))
-    except Exception as e:  # noqa: BLE001
-        health["database"] = {"status": "down", "details": str(e)}
-        http_status = 503
-    try:
-        await s3_client.head_bucket(Bucket=settings.s3_bucket_name)
-    except Exception as e:  # noqa: BLE001
-        health["storage"] = {"status": "down", "details": str(e)}
-        http_status = 503
+async def health_check(db: AsyncSession = Depends(get_read_db), s3_client=Depends(get_s3_client)):
+    global _health_cache
+    cached = _cached_health()
+    if cached is not None:
+        return cached
+    async with _health_lock:
+        # Пока ждали блокировку, проверку мог выполнить параллельный запрос
+        cached = _cached_health()
+        if cached is not None:
+            return cached
 
-    return Response(
-        content=DeepHealthCheckResponse(**health).model_dump_json(),
-        status_code=http_status,
-        media_type="application/json",
-    )
+        # Проверки идут параллельно: задержка равна самой медленной, а не их сумме
+        results = await asyncio.gather(_db_check(db), _s3_check(s3_client), return_exceptions=True)
+        health = {"api": {"status": "ok"}}
+        http_status = 200
+        for component, result in zip(("database", "storage"), results):
+            if isinstance(result, Exception):
+                health[component] = {"status": "down", "details": str(result) or type(result).__name__}
+                http_status = 503
+            else:
+                health[component] = {"status": "ok"}
+
+        body = DeepHealthCheckResponse(**health).model_dump_json().encode()
+        _health_cache = (time.monotonic(), http_status, body)
+        return Response(content=body, status_code=http_status, media_type="application/json")
 
 
 @app.get("/status", response_model=StatusResponse, tags=["Monitoring"], summary="Получение статистики по базе знаний")
 async def get_system_status(
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     current_user: User = Depends(get_current_user),
 ):
-    params = {"user_id": current_user.id, "tenant_id": current_user.tenant_id}
-
-    q1 = text("SELECT COUNT(*) FROM knowledge_events WHERE user_id = :user_id AND operation = 'created'")
-    q2 = text("SELECT COUNT(*) FROM documents WHERE tenant_id = :tenant_id")
-    q3 = text("SELECT COUNT(*) FROM chunks WHERE tenant_id = :tenant_id")
-    q4 = text("SELECT COUNT(*) FROM chunks WHERE tenant_id = :tenant_id AND embedding IS NOT NULL")
-    q5 = text("SELECT COUNT(*) FROM chunks WHERE tenant_id = :tenant_id AND metadata IS NOT NULL")
-
-    results = await asyncio.gather(
-        db.scalar(q1, params),
-        db.scalar(q2, params),
-        db.scalar(q3, params),
-        db.scalar(q4, params),
-        db.scalar(q5, params),
-    )
-
-    return StatusResponse(
-        files_uploaded_by_user=results[0],
-        documents_in_tenant=results[1],
-        chunks_in_tenant=results[2],
-        chunks_with_embedding=results[3],
-        chunks_with_metadata=results[4],
-    )
+    return await services.get_status_counts(db, current_user)
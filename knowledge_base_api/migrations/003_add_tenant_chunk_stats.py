@@ -0,0 +1,14 @@
+"""Add tenant_chunk_stats materialized view for /status counters"""
+
+from alembic import op
+
+from models import TENANT_CHUNK_STATS_DDL
+
+
+def upgrade():
+    for statement in TENANT_CHUNK_STATS_DDL:
+        op.execute(statement)
+
+
+def downgrade():
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS tenant_chunk_stats")
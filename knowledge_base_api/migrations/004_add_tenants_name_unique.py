@@ -0,0 +1,11 @@
+"""Add unique constraint on tenants.name for idempotent seeding"""
+
+from alembic import op
+
+
+def upgrade():
+    op.create_unique_constraint("tenants_name_key", "tenants", ["name"])
+
+
+def downgrade():
+    op.drop_constraint("tenants_name_key", "tenants", type_="unique")
@@ -41,13 +41,15 @@ class StatusType(str, enum.Enum):
 
 
 Base = declarative_base()
+# Версия схемы для проверки при старте (таблица schema_version); увеличивайте при изменении моделей
+Base.metadata.info["version"] = 2
 
 
 class Tenant(Base):
     __tablename__ = "tenants"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    name = Column(String, nullable=False)
+    name = Column(String, unique=True, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
@@ -118,6 +120,26 @@ class Chunk(Base):
     document = relationship("Document", backref="chunks")
 
 
+# Счетчики по chunks для /status: одна строка на тенанта, обновляется фоновой задачей.
+# Единственный источник DDL — его используют и ensure_schema при старте, и миграция 003.
+# Представление зависит от chunks.embedding: при замене колонки document-processor
+# пересоздает его по определению из каталога БД
+TENANT_CHUNK_STATS_DDL = (
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS tenant_chunk_stats AS
+    SELECT
+        tenant_id,
+        COUNT(*) AS chunks_total,
+        COUNT(*) FILTER (WHERE embedding IS NOT NULL) AS with_emb,
+        COUNT(*) FILTER (WHERE metadata IS NOT NULL) AS with_meta
+    FROM chunks
+    GROUP BY tenant_id
+    """,
+    # Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_tenant_chunk_stats_tenant ON tenant_chunk_stats (tenant_id)",
+)
+
+
 class KnowledgeEvent(Base):
     __tablename__ = "knowledge_events"
     __table_args__ = (Index("ix_knowledge_events_status_op", "status", "operation"),)
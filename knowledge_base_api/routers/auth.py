@@ -1,4 +1,3 @@
-import datetime
 import uuid
 from typing import Annotated
 
@@ -7,11 +6,13 @@ from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy import select
 
 from core import (
+    ACCESS_TOKEN_TTL_SECONDS,
     create_access_token,
     create_refresh_token,
     decode_token,
     get_current_user,
     get_db,
+    pwd_context,
     verify_password,
 )
 from models import TokenPair, User, UserPublic
@@ -27,12 +28,20 @@ async def login_for_access_token(
     result = await db.execute(select(User).where(User.username == form_data.username))
     user = result.scalars().first()
 
-    if not user or not user.is_active or not verify_password(form_data.password, user.hashed_password or ""):
+    verified, needs_rehash = (
+        verify_password(form_data.password, user.hashed_password)
+        if user and user.is_active
+        else (False, False)
+    )
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if needs_rehash:
+        user.hashed_password = pwd_context.hash(form_data.password)
+        await db.commit()
 
     token_data = {
         "sub": user.idp_subject or user.username,
@@ -45,7 +54,7 @@ async def login_for_access_token(
     return TokenPair(
         access_token=access_token,
         refresh_token=refresh_token,
-        expires_in=int(jwt_exp_delta(access_token)),
+        expires_in=ACCESS_TOKEN_TTL_SECONDS,
     )
 
 
@@ -79,13 +88,5 @@ async def refresh_access_token(payload: dict, db=Depends(get_db)):
     return TokenPair(
         access_token=new_access,
         refresh_token=new_refresh,
-        expires_in=int(jwt_exp_delta(new_access)),
+        expires_in=ACCESS_TOKEN_TTL_SECONDS,
     )
-
-
-def jwt_exp_delta(token: str) -> float:
-    from jose import jwt
-
-    payload = jwt.decode(token, "", options={"verify_signature": False, "verify_aud": False})
-    exp = payload.get("exp")
-    return float(exp - datetime.datetime.utcnow().timestamp())
@@ -57,6 +57,7 @@ async def add_file(
         db=db, s3_client=s3_client, user=current_user,
         file_stream=file.file, filename=file_name, file_size=file.size
     )
+    services.invalidate_status_cache(current_user.tenant_id)
 
     # 2. Формируем тело ответа, добавляя кастомное поле 'action'
     response_data = ItemResponse.from_orm(new_event).dict()
@@ -74,7 +75,9 @@ async def add_file(
 @router.post("/links", response_model=ItemResponse, status_code=201, summary="Добавить новую ссылку")
 async def add_link(link: LinkCreate, db=Depends(get_db), current_user: User = Depends(get_current_user)):
     """Создает новый элемент типа 'ссылка' в базе знаний."""
-    return await services.create_link_event(db=db, user=current_user, link_data=link)
+    new_event = await services.create_link_event(db=db, user=current_user, link_data=link)
+    services.invalidate_status_cache(current_user.tenant_id)
+    return new_event
 
 @router.get("/items", response_model=List[ItemResponse], summary="Получить список всех активных элементов")
 async def get_current_state_of_all_items(db=Depends(get_db), current_user: User = Depends(get_current_user)):
@@ -128,6 +131,7 @@ async def delete_item(item_uuid: uuid.UUID, db=Depends(get_db), current_user: Us
     история в БД остаются для возможности восстановления и аудита.
     """
     await services.mark_item_as_deleted(db=db, user=current_user, item_uuid=item_uuid)
+    services.invalidate_status_cache(current_user.tenant_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router.patch("/items/{item_uuid}/status", response_model=ItemResponse, summary="Обновить статус элемента")
@@ -157,4 +161,5 @@ async def update_item_status(item_uuid: uuid.UUID, status_update: StatusUpdate,
     db.add(status_change_event)
     await db.commit()
     await db.refresh(status_change_event)
+    services.invalidate_status_cache(current_user.tenant_id)
     return status_change_event
\ No newline at end of file
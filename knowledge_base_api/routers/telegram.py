@@ -5,7 +5,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from core import create_access_token, create_refresh_token, get_current_user, get_db
+from core import ACCESS_TOKEN_TTL_SECONDS, create_access_token, create_refresh_token, get_current_user, get_db
 from models import TelegramLinkStart, TelegramLinkStatus, TokenPair, User, UserTelegramLink
 
 router = APIRouter(prefix="/telegram", tags=["Telegram Links"])
@@ -70,19 +70,10 @@ async def verify_link(
     return TokenPair(
         access_token=access_token,
         refresh_token=refresh_token,
-        expires_in=int(jwt_exp_delta(access_token)),
+        expires_in=ACCESS_TOKEN_TTL_SECONDS,
     )
 
 
-def jwt_exp_delta(token: str) -> float:
-    # FastAPI path operation dependency scopes make importing here safe.
-    from jose import jwt
-
-    payload = jwt.decode(token, "", options={"verify_signature": False, "verify_aud": False})
-    exp = payload.get("exp")
-    return float(exp - datetime.datetime.utcnow().timestamp())
-
-
 @router.post("/links/{state_token}/exchange", response_model=TokenPair)
 async def exchange_tokens(state_token: str, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(UserTelegramLink).where(UserTelegramLink.state_token == state_token))
@@ -104,5 +95,5 @@ async def exchange_tokens(state_token: str, db: AsyncSession = Depends(get_db)):
     return TokenPair(
         access_token=access_token,
         refresh_token=refresh_token,
-        expires_in=int(jwt_exp_delta(access_token)),
+        expires_in=ACCESS_TOKEN_TTL_SECONDS,
     )
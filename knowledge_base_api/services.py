@@ -5,22 +5,26 @@
 Функции здесь работают с объектами базы данных и выполняют операции,
 такие как создание/обновление файлов, поиск и т.д.
 """
+import asyncio
 import datetime
 import logging
+import time
 import uuid
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from botocore.exceptions import ClientError
-from sqlalchemy import func, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 
-from core import settings
+from core import engine, settings
 from models import (
     ItemType,
     KnowledgeEvent,
     LinkCreate,
     OperationType,
+    StatusResponse,
     StatusType,
+    TENANT_CHUNK_STATS_DDL,
     User,
 )
 
@@ -228,3 +232,111 @@ async def mark_item_as_deleted(db: AsyncSession, user: User, item_uuid: uuid.UUI
     db.add(delete_event)
     await db.commit()
     return True
+
+
+# Счетчики по chunks берутся из материализованного представления tenant_chunk_stats
+# (см. TENANT_CHUNK_STATS_DDL в models), а не считаются сканом chunks
+REFRESH_TENANT_CHUNK_STATS = text("REFRESH MATERIALIZED VIEW CONCURRENTLY tenant_chunk_stats")
+TRY_LOCK_TENANT_CHUNK_STATS = text("SELECT pg_try_advisory_lock(hashtext('tenant_chunk_stats'))")
+UNLOCK_TENANT_CHUNK_STATS = text("SELECT pg_advisory_unlock(hashtext('tenant_chunk_stats'))")
+# Все счетчики /status за один round-trip
+STATUS_COUNTS_QUERY = text(
+    """
+    SELECT
+        (SELECT COUNT(*) FROM knowledge_events WHERE user_id = :user_id AND operation = 'created'),
+        (SELECT COUNT(*) FROM documents WHERE tenant_id = :tenant_id),
+        COALESCE(stats.chunks_total, 0),
+        COALESCE(stats.with_emb, 0),
+        COALESCE(stats.with_meta, 0)
+    FROM (SELECT 1) AS probe
+    LEFT JOIN tenant_chunk_stats AS stats ON stats.tenant_id = :tenant_id
+    """
+)
+# (user_id, tenant_id) -> (time.monotonic() расчета, счетчики): дашборды опрашивают /status чаще, чем меняются данные
+_STATUS_CACHE_TTL_SECONDS = 10
+_STATUS_CACHE_MAX_SIZE = 1024
+_status_cache: Dict[Tuple[uuid.UUID, uuid.UUID], Tuple[float, StatusResponse]] = {}
+_status_locks: Dict[Tuple[uuid.UUID, uuid.UUID], asyncio.Lock] = {}
+
+
+def _cached_status(key: Tuple[uuid.UUID, uuid.UUID]) -> Optional[StatusResponse]:
+    entry = _status_cache.get(key)
+    if entry is None or time.monotonic() - entry[0] >= _STATUS_CACHE_TTL_SECONDS:
+        return None
+    return entry[1]
+
+
+async def get_status_counts(db: AsyncSession, user: User) -> StatusResponse:
+    """Возвращает статистику базы знаний пользователя; одновременные промахи по ключу выполняют один запрос."""
+    key = (user.id, user.tenant_id)
+    cached = _cached_status(key)
+    if cached is not None:
+        return cached
+    lock = _status_locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            # Пока ждали блокировку, счетчики мог посчитать параллельный запрос
+            cached = _cached_status(key)
+            if cached is not None:
+                return cached
+            counts = (await db.execute(STATUS_COUNTS_QUERY, {"user_id": user.id, "tenant_id": user.tenant_id})).one()
+            status = StatusResponse(
+                files_uploaded_by_user=counts[0],
+                documents_in_tenant=counts[1],
+                chunks_in_tenant=counts[2],
+                chunks_with_embedding=counts[3],
+                chunks_with_metadata=counts[4],
+            )
+            if len(_status_cache) >= _STATUS_CACHE_MAX_SIZE:
+                _status_cache.clear()
+            _status_cache[key] = (time.monotonic(), status)
+            return status
+    finally:
+        # Лок нужен только на время заполнения: ожидающие держат ссылку на него сами,
+        # а новые запросы берут значение из кеша — словарь не растет с числом ключей
+        if _status_locks.get(key) is lock:
+            del _status_locks[key]
+
+
+def invalidate_status_cache(tenant_id: uuid.UUID) -> None:
+    """Сбрасывает закешированную статистику тенанта после изменения его элементов."""
+    for key in [key for key in _status_cache if key[1] == tenant_id]:
+        del _status_cache[key]
+
+
+async def ensure_tenant_chunk_stats(conn: AsyncConnection) -> None:
+    """Создает представление tenant_chunk_stats, если миграция 003 еще не применялась."""
+    for statement in TENANT_CHUNK_STATS_DDL:
+        await conn.execute(text(statement))
+
+
+async def refresh_tenant_chunk_stats_periodically(interval_seconds: int) -> None:
+    """
+    Фоновая задача: пересчитывает tenant_chunk_stats, не блокируя чтение /status.
+
+    Задача запускается в каждом воркере, но пересчет (полный скан chunks) выполняет только
+    владелец сессионного advisory-лока. Остальные пытаются взять лок раз в интервал
+    и подхватывают пересчет, если владелец завершился.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            async with engine.connect() as conn:
+                is_leader = await conn.scalar(TRY_LOCK_TENANT_CHUNK_STATS)
+                await conn.commit()
+                if not is_leader:
+                    continue
+                try:
+                    while True:
+                        await conn.execute(REFRESH_TENANT_CHUNK_STATS)
+                        await conn.commit()
+                        await asyncio.sleep(interval_seconds)
+                finally:
+                    # Сессионный лок пережил бы возврат соединения в пул
+                    await conn.rollback()
+                    await conn.execute(UNLOCK_TENANT_CHUNK_STATS)
+                    await conn.commit()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to refresh tenant_chunk_stats: %s", exc)